@@ -7,7 +7,9 @@ from functions import gather_remotes
 
 # Import all tasks
 import local
-from deploy import deploy, migrate
+from deploy import deploy, migrate, rollback
+from plan import plan
+from benchmark import benchmark
 
 GIT_REPO_NAME = 'project-git'
 GIT_WORKING_DIR = '/srv/active'
@@ -32,7 +34,8 @@ def setup_env(project_path):
     * **env.git_repo_name**: the remote name of the git repo.
     * **env.git_working_dir**: the remote path where the code should be deployed
 
-    * **env.config_object**: The servers.ini file loaded by the config parser
+    * **env.config_object**: The servers.ini file loaded by the config parser,
+      changes saved to it are written once at the end of the run.
     * **env.conf_filename**: The path to the servers.ini file
 
     * **env.git_remotes**: A mapping of git remote names to hosts
@@ -53,6 +56,7 @@ def setup_env(project_path):
     config = CustomConfig()
     env.conf_filename = os.path.abspath(os.path.join(project_path, 'deploy', 'servers.ini'))
     config.read([ env.conf_filename ])
+    config.write_behind()
     env.config_object = config
 
     # Add sections to the roledefs
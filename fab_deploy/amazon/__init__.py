@@ -6,3 +6,4 @@ import setup
 import api
 import utils
 import manage
+import fleet
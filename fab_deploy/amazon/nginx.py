@@ -1,4 +1,6 @@
+from fab_deploy.base.nginx import LatencyStats
 from fab_deploy.ubuntu.nginx import NginxInstall, NginxControl
 
 setup = NginxInstall()
 control = NginxControl()
+latency = LatencyStats()
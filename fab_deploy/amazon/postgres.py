@@ -1,5 +1,7 @@
-from fab_deploy.ubuntu.postgres import PostgresInstall, SlaveSetup, PGBouncerInstall
+from fab_deploy.ubuntu.postgres import PostgresInstall, SlaveSetup, \
+        MultiSlaveSetup, PGBouncerInstall
 
 setup = PostgresInstall()
 slave_setup = SlaveSetup()
+multi_slave_setup = MultiSlaveSetup()
 setup_pgbouncer = PGBouncerInstall()
@@ -4,6 +4,8 @@ import boto
 
 from fabric.api import task, run, env
 
+from fab_deploy.base import facts
+
 @task
 def get_ip(interface, hosts=[]):
     """
@@ -11,7 +13,7 @@ def get_ip(interface, hosts=[]):
     """
     # for amazon we don't ips since they may change
     if not interface:
-        return run('curl -s http://169.254.169.254/latest/meta-data/public-hostname')
+        return facts.get_fact('ip')
 
     return run(get_ip_command(interface))
 
@@ -44,3 +46,11 @@ def get_security_group(conn, section):
                                              'security group for %s' % section)
         grp.authorize('tcp', 22, 22, '0.0.0.0/0')
         return grp
+
+
+class AmazonFacts(facts.GatherFacts):
+    ip_command = 'curl -s http://169.254.169.254/latest/meta-data/public-hostname'
+    # The public hostname changes when an instance is stopped and started
+    volatile = ('ip',)
+
+get_facts = AmazonFacts()
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+
+from fabric.api import run, env, execute
+from fabric.tasks import Task
+from fabric.context_managers import settings, hide
+
+from fab_deploy import functions
+
+# Facts older than this many seconds are probed again
+FACTS_TTL = 24 * 60 * 60
+# Hosts probed at once unless fab's -z option is given
+POOL_SIZE = 20
+
+def _get_facts_file():
+    return env.get('facts_file', os.path.join(os.path.expanduser('~'),
+                                              '.fab_deploy', 'facts.json'))
+
+def _get_key(host):
+    """
+    Facts are cached per project, as the same address can
+    be a different server for another project.
+    """
+    return '%s %s' % (env.get('project_path') or '', host)
+
+def _read():
+    path = _get_facts_file()
+    cache = {}
+    if os.path.exists(path):
+        fp = open(path)
+        try:
+            cache = json.load(fp)
+        except ValueError:
+            pass
+        fp.close()
+    return cache
+
+def _load():
+    if env.get('host_facts') is None:
+        env.host_facts = _read()
+    return env.host_facts
+
+def _save(keys):
+    """
+    Writes the entries of keys to the facts file, keeping
+    what other processes wrote to it since it was loaded.
+    """
+    path = _get_facts_file()
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    cache = _read()
+    for key in keys:
+        if key in env.host_facts:
+            cache[key] = env.host_facts[key]
+        else:
+            cache.pop(key, None)
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    fp = open(tmp_path, 'w')
+    json.dump(cache, fp, indent=1, sort_keys=True)
+    fp.close()
+    os.rename(tmp_path, path)
+
+def _is_fresh(facts):
+    ttl = env.get('facts_ttl', FACTS_TTL)
+    return facts and time.time() - facts.get('_time', 0) < ttl
+
+def gather_facts(hosts, refresh=False):
+    """
+    Makes sure the facts for all hosts are cached, probing
+    the ones that are missing or stale in parallel with one
+    round trip each. Hosts that couldn't be probed get {}.
+    """
+    cache = _load()
+    missing = [h for h in hosts
+               if refresh or not _is_fresh(cache.get(_get_key(h)))]
+    if missing:
+        with settings(pool_size=env.pool_size or POOL_SIZE):
+            results = execute('utils.get_facts', hosts=missing)
+        keys = []
+        for host, facts in results.items():
+            if isinstance(facts, dict):
+                facts['_time'] = time.time()
+                cache[_get_key(host)] = facts
+                keys.append(_get_key(host))
+        _save(keys)
+    return dict([(h, cache.get(_get_key(h), {})) for h in hosts])
+
+def get_facts(host=None, refresh=False):
+    """
+    Returns the facts of host, env.host_string if not given.
+    """
+    if not host:
+        host = env.host_string
+    host_facts = gather_facts([host], refresh=refresh)[host]
+    if not host_facts:
+        print "Couldn't probe the facts of %s" % host
+        sys.exit(1)
+    return host_facts
+
+def is_volatile(name):
+    """
+    Returns True if the platform's facts task can't cache name.
+    """
+    task = functions.get_task_instance('utils.get_facts')
+    return name in getattr(task, 'volatile', ())
+
+def get_fact(name, host=None, default=None):
+    """
+    Returns a single fact of host, env.host_string if not given.
+    Volatile facts of the platform are probed again every time.
+    """
+    value = get_facts(host, refresh=is_volatile(name)).get(name)
+    if value in (None, ''):
+        return default
+    return value
+
+def clear_facts(host=None):
+    """
+    Forgets the facts of host so they are probed again.
+    Call it after a task changes what the facts describe,
+    like installing packages.
+    """
+    if not host:
+        host = env.host_string
+    cache = _load()
+    key = _get_key(host)
+    cache.pop(key, None)
+    _save([key])
+
+class GatherFacts(Task):
+    """
+    Probe the facts of a host in a single round trip.
+
+    Returns a dict with its internal ip, os, cores, memory (MB),
+    python version, and the postgres home, data dir and version
+    if postgres is installed.
+
+    Other tasks should not call this directly, but read the cached
+    facts with ``fab_deploy.base.facts.get_facts``.
+    """
+
+    name = 'get_facts'
+    parallel = True
+
+    ip_command = None
+    # Facts that can change while the host keeps its address,
+    # so ``get_fact`` never reads them from the cache
+    volatile = ()
+
+    def _get_commands(self):
+        return [
+            ('ip', self.ip_command),
+            ('os', 'uname -s'),
+            ('cores', 'if [ -r /proc/cpuinfo ]; then '
+                      'grep -c ^processor /proc/cpuinfo; '
+                      'else psrinfo | wc -l; fi'),
+            ('memory', "if [ -r /proc/meminfo ]; then "
+                       "awk '/^MemTotal/ {print int($2 / 1024)}' /proc/meminfo; "
+                       "else prtconf 2>/dev/null | "
+                       "awk '/^Memory size/ {print $3}'; fi"),
+            ('python_version', "python -V 2>&1 | awk '{print $2}'"),
+            ('postgres_home', 'grep ^postgres: /etc/passwd | cut -d: -f6'),
+            ('pgdata', 'echo $PGDATA'),
+            ('psql_version', "psql --version 2>/dev/null | head -1 | "
+                             "awk '{print $3}'"),
+        ]
+
+    def _parse(self, output):
+        facts = {}
+        for line in output.splitlines():
+            key, sep, value = line.partition('=')
+            if sep:
+                value = value.strip()
+                if value.isdigit():
+                    value = int(value)
+                facts[key.strip()] = value
+        return facts
+
+    def run(self):
+        commands = ['echo %s=$(%s)' % (k, c) for k, c in self._get_commands()
+                    if c]
+        with settings(hide('running', 'output')):
+            output = run('; '.join(commands))
+        return self._parse(output)
@@ -34,15 +34,5 @@ class BaseUpdateFiles(Task):
     def _save_to_file(self, section, lines):
         file_path = self.get_section_path(section)
 
-        new_path = file_path + '.bak'
-        cmd = "awk '{\
-                tmp = match($0, \"%s\"); \
-                if (tmp) { \
-                    print \"%s\"; \
-                    while(getline>0){tmp2 = match($0, \"%s\"); if (tmp2) break;} \
-                    next;} \
-                {print $0}}' %s > %s" %(lines[0], '\\n'.join(lines), lines[-1],
-                                        file_path, new_path)
-        local(cmd)
-        local('mv %s %s' %(new_path, file_path))
+        functions.replace_block(file_path, lines[0], lines[-1], lines)
         return file_path
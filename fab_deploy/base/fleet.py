@@ -0,0 +1,277 @@
+import sys
+import time
+
+from fabric.api import env, execute, settings
+from fabric.decorators import parallel
+from fabric.tasks import Task
+
+from fab_deploy import functions
+from fab_deploy.base import facts
+
+class Converge(Task):
+    """
+    Brings every host in your server.ini to its desired state.
+
+    Each section with connections is set up with its setup task,
+    found in section_tasks or in the setup-task option of the
+    section. A section is set up after the sections it depends on.
+    These come from the dependencies attribute or from a comma
+    separated depends-on option. So by default the db-server comes
+    before its slaves and the app servers, and the app servers come
+    before the load balancers.
+
+    The sections are set up in stages. All hosts of the sections in
+    a stage are set up at the same time, pool_size at a time (or the
+    value of fab's -z option). The hosts of serial_sections are set
+    up one after the other in this process. By default these are the
+    db-server and slave-db, as their setup prompts for input, which
+    forked processes can't read, and so only one base backup is taken
+    from the master at a time.
+
+    Hosts are set up in forked processes, so only this task changes
+    local state. Before the first stage it:
+
+    * fills in any missing internal ips,
+    * adds the git remotes,
+    * preps the deploy,
+    * generates the firewall and snmp files.
+
+    After each stage it merges the config changes every host
+    returned and writes server.ini once. Then it updates the nginx
+    configs that depend on the sections in that stage.
+
+    Like the setup tasks, this task doesn't commit the files it
+    changes in your deploy directory. Review and commit them.
+
+    Takes the following optional arguments:
+
+    * **sections**: A semicolon separated list of the sections to
+                  converge. Defaults to all of them.
+
+    * **branch**: The branch prepped for deployment, master by default.
+
+    This is a serial task, that should not be called with any remote
+    hosts as they are determined by your server.ini file.
+    """
+
+    name = 'converge'
+    serial = True
+    pool_size = 10
+
+    section_tasks = {
+        'db-server': 'setup.db_server',
+        'slave-db': 'setup.slave_db',
+        'app-server': 'setup.app_server',
+        'load-balancer': 'setup.lb_server',
+        'dev-server': 'setup.dev_server',
+    }
+    dependencies = {
+        'slave-db': ['db-server'],
+        'app-server': ['db-server'],
+        'load-balancer': ['app-server'],
+    }
+    # Their setup prompts, or must not run concurrently
+    serial_sections = ['db-server', 'slave-db']
+
+    def _get_sections(self, sections=None):
+        """
+        Returns a dict of the sections to converge
+        and the names of their setup tasks.
+        """
+        conf = env.config_object
+        if sections:
+            names = [s.strip() for s in sections.split(';') if s.strip()]
+        else:
+            names = conf.server_sections()
+
+        result = {}
+        for section in names:
+            if not conf.get_list(section, conf.CONNECTIONS):
+                continue
+
+            if conf.has_option(section, conf.SETUP_TASK):
+                task_name = conf.get(section, conf.SETUP_TASK)
+            else:
+                task_name = self.section_tasks.get(section)
+
+            if not task_name or not functions.get_task_instance(task_name):
+                print "Skipping %s, there is no setup task for it" % section
+                continue
+            result[section] = task_name
+        return result
+
+    def _get_dependencies(self, section, sections):
+        conf = env.config_object
+        if conf.has_option(section, conf.DEPENDS_ON):
+            depends = conf.get_list(section, conf.DEPENDS_ON)
+        else:
+            depends = self.dependencies.get(section, [])
+        return [d for d in depends if d in sections]
+
+    def _get_stages(self, sections):
+        """
+        Returns a list of stages, each a list of sections that
+        only depend on sections in earlier stages.
+        """
+        depends = dict([(s, self._get_dependencies(s, sections))
+                        for s in sections])
+        done = set()
+        stages = []
+        while len(done) < len(sections):
+            stage = sorted([s for s in sections if not s in done and
+                            done.issuperset(depends[s])])
+            if not stage:
+                print ("The dependencies of %s form a cycle"
+                       % ', '.join(sorted(set(sections) - done)))
+                sys.exit(1)
+            stages.append(stage)
+            done.update(stage)
+        return stages
+
+    def _update_internal_ips(self, sections):
+        conf = env.config_object
+        missing = []
+        hosts = []
+        for section in sections:
+            connections = conf.get_list(section, conf.CONNECTIONS)
+            ips = conf.get_list(section, conf.INTERNAL_IPS)
+            if len(ips) != len(connections):
+                missing.append(section)
+                hosts.extend([c for c in connections if not c in hosts])
+
+        if not hosts:
+            return
+
+        results = facts.gather_facts(hosts, refresh=facts.is_volatile('ip'))
+        for section in missing:
+            ips = []
+            for host in conf.get_list(section, conf.CONNECTIONS):
+                if not results[host].get('ip'):
+                    print "Couldn't get the internal ip of %s" % host
+                    sys.exit(1)
+                ips.append(results[host]['ip'])
+            conf.set_list(section, conf.INTERNAL_IPS, ips)
+
+    def _add_remotes(self, sections):
+        conf = env.config_object
+        for section, task_name in sections.items():
+            task = functions.get_task_instance(task_name)
+            if hasattr(task, '_add_remote'):
+                for host in conf.get_list(section, conf.CONNECTIONS):
+                    with settings(host_string=host):
+                        task._add_remote()
+
+    def _prep_deploy(self, sections, branch):
+        conf = env.config_object
+        for section, task_name in sections.items():
+            task = functions.get_task_instance(task_name)
+            if hasattr(task, 'git_branch'):
+                host = conf.get_list(section, conf.CONNECTIONS)[0]
+                execute('local.deploy.prep', branch=branch, hosts=[host])
+                env.deploy_ready = True
+                return
+
+    def _update_files(self, sections):
+        conf = env.config_object
+        firewall = functions.get_task_instance('firewall.update_files')
+        snmp = functions.get_task_instance('snmp.update_files')
+
+        for section, task_name in sections.items():
+            task = functions.get_task_instance(task_name)
+            if snmp and getattr(task, 'setup_snmp', False):
+                execute('snmp.update_files', section=section)
+
+            if firewall and getattr(task, 'setup_firewall', False):
+                execute('firewall.update_files', section=section)
+                for other in conf.server_sections():
+                    if other != section and section in conf.get_list(other,
+                                                    conf.ALLOWED_SECTIONS):
+                        execute('firewall.update_files', section=other)
+
+    def _setup_host(self, host_tasks):
+        """
+        Runs the setup task of env.host_string and returns
+        the config changes it made instead of saving them.
+        """
+        conf = env.config_object
+        conf.write_behind()
+        with settings(warn_only=False):
+            execute(host_tasks[env.host_string], hosts=[env.host_string])
+        return conf.pop_changes()
+
+    def _run_stage(self, stage, sections):
+        conf = env.config_object
+        host_tasks = {}
+        parallel_hosts = []
+        serial_hosts = []
+        for section in stage:
+            for host in conf.get_list(section, conf.CONNECTIONS):
+                if host in host_tasks:
+                    print "Skipping %s in %s, it is already set up" % (host,
+                                                                      section)
+                    continue
+
+                host_tasks[host] = sections[section]
+                if section in self.serial_sections:
+                    serial_hosts.append(host)
+                else:
+                    parallel_hosts.append(host)
+
+        if parallel_hosts:
+            with settings(warn_only=True,
+                          pool_size=env.pool_size or self.pool_size):
+                results = execute(parallel(pool_size=None)(self._setup_host),
+                                  host_tasks, hosts=parallel_hosts)
+
+            failed = []
+            for host in parallel_hosts:
+                if isinstance(results.get(host), list):
+                    conf.apply_changes(results[host])
+                else:
+                    failed.append(host)
+
+            conf.save(env.conf_filename)
+            conf.flush()
+            if failed:
+                print "Setting up %s failed" % ', '.join(failed)
+                sys.exit(1)
+
+        for host in serial_hosts:
+            results = execute(self._setup_host, host_tasks, hosts=[host])
+            conf.apply_changes(results[host])
+            conf.save(env.conf_filename)
+            conf.flush()
+
+        for section in stage:
+            task = functions.get_task_instance(sections[section])
+            if hasattr(task, '_modify_others'):
+                task._modify_others()
+
+    def run(self, sections=None, branch=None):
+        sections = self._get_sections(sections)
+        if not sections:
+            print "There is nothing to converge"
+            return
+
+        stages = self._get_stages(sections)
+
+        self._update_internal_ips(sections)
+        env.config_object.save(env.conf_filename)
+        env.config_object.flush()
+
+        self._add_remotes(sections)
+        self._prep_deploy(sections, branch)
+        self._update_files(sections)
+
+        tasks = [functions.get_task_instance(t) for t in sections.values()]
+        for task in tasks:
+            task.coordinated = True
+        try:
+            for i, stage in enumerate(stages):
+                start = time.time()
+                self._run_stage(stage, sections)
+                print "Stage %s (%s) took %.1f seconds" % (i + 1,
+                                ', '.join(stage), time.time() - start)
+        finally:
+            for task in tasks:
+                task.coordinated = False
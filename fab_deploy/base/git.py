@@ -7,6 +7,7 @@ from fabric.context_managers import settings, hide
 from fab_deploy.functions import get_config_filepath
 
 DEFAULT_GIT_HOOK = 'git/post-receive'
+INSTALL_REQUIREMENTS = 'install-requirements'
 
 class Install(Task):
     """
@@ -47,6 +48,9 @@ class UpdateHook(Task):
 
     * **hook**: Path to the hook you want installed. If not
               given the default git/post-receive is used.
+
+    Also installs hooks/install-requirements, which your hook can
+    call to install requirements only when they changed.
     """
 
     name = 'update_hook'
@@ -56,3 +60,8 @@ class UpdateHook(Task):
         path = os.path.join(env.git_repo_name, "hooks", "post-receive")
         put(file_path, path)
         run('chmod +x %s' % path)
+
+        script = os.path.join(env.configs_dir, 'install-requirements.sh')
+        path = os.path.join(env.git_repo_name, "hooks", INSTALL_REQUIREMENTS)
+        put(script, path)
+        run('chmod +x %s' % path)
@@ -1,20 +1,181 @@
 import os
+import sys
+import time
 
 from fabric.api import run, sudo, env
 from fabric.tasks import Task
+from fabric.context_managers import settings, hide
 
-from fab_deploy.base import setup
+from fab_deploy.base import setup, facts
 from fab_deploy import functions
 
 class Control(setup.Control):
+    """
+    Start, stop, restart or reload gunicorn.
+
+    Passing reload=True reloads gunicorn gracefully so the host
+    never stops serving requests. How depends on reload_method:
+
+    * **HUP**: gunicorn starts new workers and gracefully retires
+             the old ones itself, so a failure can only be reported.
+             Once all new workers are up the health check is run.
+
+    * **USR2**: a new master is started next to the old one. Only
+              when all its workers are up and the health check passes
+              are the old workers drained with WINCH, otherwise the new
+              master is stopped. The check is then run again against
+              the new workers alone. If they pass the old master is
+              stopped with QUIT, otherwise the old master is sent HUP
+              to bring its workers back and the new one is stopped.
+
+    USR2 requires a service manager that keeps tracking gunicorn
+    when the new master is reparented, like SMF.
+    """
+
+    reload_method = 'HUP'
+
+    health_url = 'http://127.0.0.1:8000/'
+    health_timeout = 60
 
     def get_name(self):
         task = functions.get_task_instance('gunicorn.setup')
         return task.gunicorn_name
 
+    def _get_master_pid(self):
+        raise NotImplementedError()
+
+    def _get_children(self, pid):
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = run('pgrep -P %s' % pid)
+        return output.split()
+
+    def _wait_for_exit(self, pids):
+        if not pids:
+            return
+
+        with settings(warn_only=True):
+            run('i=0; while [ $i -lt %s ] && kill -0 %s 2>/dev/null; do '
+                'sleep 1; i=`expr $i + 1`; done' % (self.health_timeout,
+                                                    ' '.join(pids)))
+
+    def _wait_for_health(self):
+        """
+        Polls health_url until it gets an answer that isn't a server
+        error. Returns False if that doesn't happen in health_timeout
+        seconds.
+        """
+        with settings(warn_only=True):
+            result = run("i=0; while [ $i -lt %s ]; do "
+                         "code=`curl -s -o /dev/null -w '%%{http_code}' %s`; "
+                         "case $code in 000|5*) sleep 1; i=`expr $i + 1`;; "
+                         "*) exit 0;; esac; done; exit 1"
+                         % (self.health_timeout, self.health_url))
+        return not result.failed
+
+    def _wait_for_new_master(self, old_master, old_workers):
+        for i in range(self.health_timeout):
+            for pid in self._get_children(old_master):
+                if pid not in old_workers and self._get_children(pid):
+                    return pid
+            time.sleep(1)
+        return None
+
+    def _wait_for_workers(self, master, count, old_workers=()):
+        """
+        Waits until master has count workers that aren't in
+        old_workers and the same ones are still there a second
+        later, so they booted. Returns False if that doesn't
+        happen in health_timeout seconds.
+        """
+        previous = None
+        for i in range(self.health_timeout):
+            workers = set([pid for pid in self._get_children(master)
+                           if pid not in old_workers])
+            if len(workers) >= count and workers == previous:
+                return True
+            previous = workers
+            time.sleep(1)
+        return False
+
+    def _reload_hup(self, master):
+        # gunicorn retires the old workers itself as soon as it
+        # has forked the new ones, so they can't be kept around
+        # until the new ones are checked.
+        old_workers = self._get_children(master)
+        sudo('kill -HUP %s' % master)
+
+        if not (self._wait_for_workers(master, max(len(old_workers), 1),
+                                       old_workers) and
+                self._wait_for_health()):
+            print "gunicorn workers failed the health check after reload"
+            sys.exit(1)
+
+    def _reload_usr2(self, old_master):
+        old_workers = self._get_children(old_master)
+        sudo('kill -USR2 %s' % old_master)
+
+        new_master = self._wait_for_new_master(old_master, old_workers)
+        if not new_master:
+            print "gunicorn didn't start a new master, keeping the old one"
+            sys.exit(1)
+
+        # Only retire the old workers once all new ones are up
+        if not (self._wait_for_workers(new_master,
+                                       max(len(old_workers), 1)) and
+                self._wait_for_health()):
+            sudo('kill -QUIT %s' % new_master)
+            print ("new gunicorn workers didn't come up, "
+                   "kept the old master")
+            sys.exit(1)
+
+        sudo('kill -WINCH %s' % old_master)
+        self._wait_for_exit(old_workers)
+
+        # Now only the new workers answer on the socket
+        if self._wait_for_health():
+            sudo('kill -QUIT %s' % old_master)
+        else:
+            sudo('kill -HUP %s' % old_master)
+            sudo('kill -QUIT %s' % new_master)
+            print ("new gunicorn workers failed the health check, "
+                   "kept the old master")
+            sys.exit(1)
+
+    def reload(self):
+        master = self._get_master_pid()
+        if not master:
+            self.start()
+        elif self.reload_method == 'USR2':
+            self._reload_usr2(master)
+        else:
+            self._reload_hup(master)
+
 class GunicornInstall(Task):
     """
     Install gunicorn and set it up with svcadm.
+
+    Unless autotune is turned off the host's cores and memory are
+    probed. The worker count is computed from them, as are the
+    threads of each worker when worker_class is gthread. The backlog
+    is sized from the number of requests the workers serve at once,
+    up to max_backlog. The worker class and max requests (with
+    jitter) are the class's defaults. The values are
+    rendered into the service definition as GUNICORN_CMD_ARGS, so
+    the definition your project ships should not hard code them
+    (this requires gunicorn 19.7 or later).
+
+    Any of the values can be overridden for a section of your
+    server.ini with the workers, worker-class, threads, max-requests,
+    max-requests-jitter and backlog options. The probed cores and
+    memory and the resulting worker count are recorded per host in
+    the host-cores, host-memory and host-workers options.
+
+    Takes the following optional arguments:
+
+    * **env_value**: The value of your project's environment variable.
+
+    * **section**: The section of your server.ini this host belongs to.
+                 If not provided it is looked up from the connections.
     """
 
     name = 'setup'
@@ -26,9 +187,35 @@ class GunicornInstall(Task):
     gunicorn_name = 'gunicorn'
     log_name = 'django.log'
 
+    autotune = True
+    # MB of memory budgeted for each worker
+    worker_memory = 128
+    worker_class = 'sync'
+    async_worker_classes = ('gevent', 'eventlet', 'tornado')
+    # Threads of each gthread worker for every core of the host
+    threads_per_core = 2
+    # gunicorn's default for async workers
+    worker_connections = 1000
+    max_requests = 1000
+    # Connections queued for each request the workers serve at once
+    backlog_per_request = 64
+    max_backlog = 2048
+
+    TUNING_OPTIONS = (
+        ('workers', 'WORKERS'),
+        ('worker_class', 'WORKER_CLASS'),
+        ('threads', 'THREADS'),
+        ('max_requests', 'MAX_REQUESTS'),
+        ('max_requests_jitter', 'MAX_REQUESTS_JITTER'),
+        ('backlog', 'BACKLOG'),
+    )
+
     def _setup_service(self, env_value=None):
         raise NotImplementedError()
 
+    def _setup_tuning(self, args):
+        raise NotImplementedError()
+
     def _setup_logs(self):
         path = os.path.join(self.log_dir, self.log_name)
         sudo('mkdir -p %s' % self.log_dir)
@@ -40,9 +227,95 @@ class GunicornInstall(Task):
     def _setup_rotate(self, path):
         raise NotImplementedError()
 
-    def run(self, env_value=None):
+    def update_conf(self):
+        """
+        Called by deploy after the code is updated, to pick up
+        changes to a service definition copied at setup.
+        """
+        pass
+
+    def _get_host_info(self):
+        """
+        Returns the number of cores and the MB of memory
+        of the current host.
+        """
+        host_facts = facts.get_facts()
+        return int(host_facts['cores']), int(host_facts['memory'])
+
+    def _get_tuning(self, section, cores, memory):
+        conf = env.config_object
+        overrides = {}
+        if section:
+            for key, option in self.TUNING_OPTIONS:
+                option = getattr(conf, option)
+                if conf.has_option(section, option):
+                    overrides[key] = conf.get(section, option)
+
+        worker_class = overrides.get('worker_class', self.worker_class)
+        if (worker_class in self.async_worker_classes or
+                worker_class == 'gthread'):
+            workers = cores + 1
+        else:
+            workers = 2 * cores + 1
+        workers = max(min(workers, memory / self.worker_memory), 1)
+        workers = int(overrides.get('workers', workers))
+
+        threads = 1
+        if worker_class == 'gthread':
+            threads = max(self.threads_per_core * cores, 2)
+        threads = int(overrides.get('threads', threads))
+
+        if worker_class in self.async_worker_classes:
+            concurrency = workers * self.worker_connections
+        else:
+            concurrency = workers * threads
+        backlog = min(concurrency * self.backlog_per_request,
+                      self.max_backlog)
+
+        max_requests = int(overrides.get('max_requests', self.max_requests))
+        tuning = {
+            'workers': workers,
+            'worker_class': worker_class,
+            'threads': threads,
+            'max_requests': max_requests,
+            'max_requests_jitter': max_requests / 10,
+            'backlog': backlog,
+        }
+        tuning.update(overrides)
+        return tuning
+
+    def _get_tuning_args(self, tuning):
+        args = []
+        for key, option in self.TUNING_OPTIONS:
+            args.append('--%s %s' % (key.replace('_', '-'), tuning[key]))
+        return ' '.join(args)
+
+    def _record_tuning(self, section, cores, memory, tuning):
+        conf = env.config_object
+        for option, value in ((conf.HOST_CORES, cores),
+                              (conf.HOST_MEMORY, memory),
+                              (conf.HOST_WORKERS, tuning['workers'])):
+            values = conf.get_dict(section, option)
+            values[env.host_string] = value
+            conf.set_dict(section, option, values)
+
+    def run(self, env_value=None, section=None, save_config=True):
         """
         """
         self._setup_service(env_value)
+
+        if self.autotune:
+            if not section:
+                section = env.config_object.get_host_section(env.host_string)
+
+            cores, memory = self._get_host_info()
+            tuning = self._get_tuning(section, cores, memory)
+            self._setup_tuning(self._get_tuning_args(tuning))
+
+            if section:
+                self._record_tuning(section, cores, memory, tuning)
+                if save_config:
+                    env.config_object.save(env.conf_filename)
+
         path = self._setup_logs()
         self._setup_rotate(path)
@@ -2,8 +2,11 @@ import os
 
 from fabric.api import run, sudo, env, local
 from fabric.tasks import Task
+from fabric.context_managers import settings, hide
 
 DEFAULT_NGINX_CONF = "nginx/nginx.conf"
+CACHE_DIR = '/var/www/cache'
+CACHE_TMP_DIR = '/var/www/cache-tmp'
 
 class NginxInstall(Task):
     """
@@ -42,8 +45,8 @@ class NginxInstall(Task):
         raise NotImplementedError()
 
     def _setup_dirs(self):
-        sudo('mkdir -p /var/www/cache-tmp')
-        sudo('mkdir -p /var/www/cache')
+        sudo('mkdir -p %s' % CACHE_TMP_DIR)
+        sudo('mkdir -p %s' % CACHE_DIR)
         sudo('chown -R %s:%s /var/www' % (self.user, self.group))
 
     def _setup_config(self, nginx_conf=None, directory=None):
@@ -54,3 +57,46 @@ class NginxInstall(Task):
         else:
             remote_config_path = self.remote_config_path
         sudo('ln -sf %s %s' % (remote_conv, remote_config_path))
+
+class LatencyStats(Task):
+    """
+    Summarize the response times of the app servers behind
+    a load balancer.
+
+    Reads the requests of the last window seconds (300 by default)
+    from log_file. Your load balancer's nginx config has to log them
+    in this format::
+
+        log_format latency '$upstream_addr $status $upstream_response_time $msec';
+        access_log /var/log/nginx/latency.log latency;
+
+    Returns a dict of upstream addresses, like 10.0.0.1:8000, to a
+    dict with the counts of their response times in milliseconds
+    and the number of server errors. Requests that were retried on
+    another server are left out.
+    """
+
+    name = 'latency'
+    log_file = '/var/log/nginx/latency.log'
+
+    def run(self, window=300):
+        with settings(hide('running', 'output')):
+            output = sudo("awk -v window=%s 'BEGIN { srand(); "
+                          "since = srand() - window } "
+                          "NF == 4 && $4 >= since && $3 != \"-\" { "
+                          "t[$1 \" \" int($3 * 1000)]++; "
+                          "if ($2 >= 500) e[$1]++ } "
+                          "END { for (k in t) print \"t\", k, t[k]; "
+                          "for (k in e) print \"e\", k, e[k] }' %s"
+                          % (int(window), self.log_file))
+
+        stats = {}
+        for line in output.splitlines():
+            parts = line.split()
+            if parts and parts[0] == 't' and len(parts) == 4:
+                addr = stats.setdefault(parts[1], {'times': {}, 'errors': 0})
+                addr['times'][int(parts[2])] = int(parts[3])
+            elif parts and parts[0] == 'e' and len(parts) == 3:
+                addr = stats.setdefault(parts[1], {'times': {}, 'errors': 0})
+                addr['errors'] = int(parts[2])
+        return stats
@@ -6,10 +6,12 @@ from fabric.contrib.files import append, sed, exists, contains
 from fabric.context_managers import prefix
 from fabric.operations import get, put
 from fabric.context_managers import cd
+from fabric.decorators import parallel
 
 from fabric.tasks import Task
 
 from fab_deploy.functions import random_password
+from fab_deploy.base import facts
 
 class PostgresInstall(Task):
     """
@@ -52,13 +54,12 @@ class PostgresInstall(Task):
         return data_dir
 
     def _get_home_dir(self):
-        output = run('grep postgres /etc/passwd | cut -d: -f6')
-        return output.stdout
+        return facts.get_fact('postgres_home', default='')
 
     def _get_data_dir(self, db_version):
-        output = run('echo $PGDATA')
-        if output.stdout and exists(output.stdout, use_sudo=True):
-            return output.stdout
+        pgdata = facts.get_fact('pgdata')
+        if pgdata and exists(pgdata, use_sudo=True):
+            return pgdata
 
         data_path = self.data_dir_default_base
         data_version_path = os.path.join(data_path, 'data%s' %db_version)
@@ -174,6 +175,13 @@ class PostgresInstall(Task):
     def _install_package(self, db_version):
         raise NotImplementedError()
 
+    def _refresh_facts(self):
+        """
+        The cached facts of the host don't describe the
+        postgres that was just installed or upgraded.
+        """
+        facts.clear_facts()
+
     def _restart_db_server(self, db_version):
         raise NotImplementedError()
 
@@ -190,6 +198,7 @@ class PostgresInstall(Task):
         db_version = self._get_db_version(db_version)
 
         self._install_package(db_version)
+        self._refresh_facts()
         data_dir = self._get_data_dir(db_version)
         config_dir = self._get_config_dir(db_version, data_dir)
 
@@ -213,19 +222,45 @@ class PostgresInstall(Task):
 class SlaveSetup(PostgresInstall):
     """
     Set up master-slave streaming replication: slave node
+
+    Takes the following arguments:
+
+    * **master**: Required. The connection string of the master db.
+
+    * **source**: The connection string of the server the base backup
+                is copied from. Defaults to the master. Pass an existing
+                slave to seed this one with pg_basebackup without
+                reading the master's data directory (requires postgres
+                9.2 or later).
+
+    * **upstream**: The connection string of the server this slave
+                  streams from. Defaults to the source, so a slave
+                  seeded from another slave cascades from it (cascading
+                  replication requires postgres 9.2 or later).
     """
 
     name = 'slave_setup'
 
     postgres_config = {
-        'listen_addresses': "'*'",
-        'wal_level':      "hot_standby",
-        'hot_standby':    "on"}
+        'listen_addresses':  "'*'",
+        'wal_level':         "hot_standby",
+        'hot_standby':       "on",
+        'wal_keep_segments': "32",
+        'max_wal_senders':   "5"}
 
     def _get_master_db_version(self):
-        output = run("psql --version | head -1 | awk '{print $3}'")
-        if output.stdout:
-            return self._get_db_version(output.stdout)
+        version = facts.get_fact('psql_version')
+        if version:
+            return self._get_db_version(str(version))
+
+    def _supports_cascading(self):
+        """
+        Returns True if the postgres in env.host_string can stream
+        to and take base backups from a standby, which needs 9.2.
+        """
+        version = str(facts.get_fact('psql_version') or self.db_version)
+        parts = [int(x) for x in version.split('.')[:2] if x.isdigit()]
+        return parts >= [9, 2]
 
     def _get_replicator_pass(self):
         try:
@@ -238,6 +273,11 @@ class SlaveSetup(PostgresInstall):
                    "in your db-server, and register its info in server.ini")
             sys.exit(1)
 
+    def _get_ip(self, host):
+        ip = facts.get_fact('ip', host)
+        assert ip
+        return ip
+
     def _setup_recovery_conf(self, master_ip, password, data_dir):
         psql_bin = ''
         if self.binary_path:
@@ -255,6 +295,8 @@ class SlaveSetup(PostgresInstall):
                 ("archive_cleanup_command = '%spg_archivecleanup %s %s'\n"
                     %(psql_bin, wal_dir, "%r")))
 
+        # A base backup taken from another slave carries its recovery.conf
+        sudo('rm -f %s' % recovery_conf)
         sudo('touch %s' % recovery_conf)
         append(recovery_conf, txts, use_sudo=True)
         sudo('chown postgres:postgres %s' %recovery_conf)
@@ -274,54 +316,172 @@ class SlaveSetup(PostgresInstall):
         with settings(host_string=slave):
             authorized_keys = os.path.join(ssh_dir, 'authorized_keys')
             with hide('output', 'running'):
-                run('sudo su postgres -c "echo %s >> %s"'
-                    %(pub_key, authorized_keys))
+                run('sudo su postgres -c "grep -qF \'%s\' %s 2>/dev/null || '
+                    'echo %s >> %s"' %(pub_key, authorized_keys,
+                                       pub_key, authorized_keys))
 
-    def run(self, master=None, encrypt=None, section=None, **kwargs):
+    def _prepare_slave(self, master, source, db_version):
         """
+        Installs postgres on the slave in env.host_string and stops
+        it so its data directory can be replaced.
         """
-        if not master:
-            print "Hey, a master is required for slave."
-            sys.exit(1)
-
-        results = execute('utils.get_ip', None, hosts=[master])
-        master_ip = results[master]
-        assert master_ip
-
-        replicator_pass = self._get_replicator_pass()
-
-        with settings(host_string=master):
-            db_version = self._get_master_db_version()
-
-        slave = env.host_string
-        slave_ip = slave.split('@')[1]
-
         self._install_package(db_version)
+        self._refresh_facts()
         data_dir = self._get_data_dir(db_version)
-        config_dir = self._get_config_dir(db_version, data_dir)
 
         self._stop_db_server(db_version)
 
-        self._setup_ssh_key()
-        self._ssh_key_exchange(master, slave)
+        # Only the rsync from the master goes over ssh
+        if source == master:
+            self._setup_ssh_key()
+            self._ssh_key_exchange(master, env.host_string)
+        return data_dir
+
+    def _copy_from_master(self, master, data_dir, slaves):
+        """
+        Takes one base backup on the master and rsyncs it to
+        all the slaves at the same time.
+        """
+        cmds = []
+        for slave in slaves:
+            cmds.append('rsync -a --exclude postmaster.pid '
+                        '--exclude pg_xlog --exclude server.crt '
+                        '--exclude server.key '
+                        '%s/ postgres@%s:%s/ & pids="$pids $!"'
+                            %(data_dir, slave.split('@')[1], data_dir))
 
         with settings(host_string=master):
             run('echo "select pg_start_backup(\'backup\', true)" | sudo su postgres -c \'psql\'')
-            run('sudo su postgres -c "rsync -av --exclude postmaster.pid '
-                '--exclude pg_xlog --exclude server.crt '
-                '--exclude server.key '
-                '%s/ postgres@%s:%s/"'%(data_dir, slave_ip, data_dir))
-            run('echo "select pg_stop_backup()" | sudo su postgres -c \'psql\'')
+            try:
+                run("sudo su postgres -c 'pids=\"\"; %s; "
+                    "for p in $pids; do wait $p || exit 1; done'"
+                    % '; '.join(cmds))
+            finally:
+                run('echo "select pg_stop_backup()" | sudo su postgres -c \'psql\'')
+
+    def _copy_from_slave(self, source_ip, password, db_version):
+        """
+        Pulls a base backup from an existing slave into the data
+        directory of the slave in env.host_string.
+        """
+        psql_bin = ''
+        if self.binary_path:
+            psql_bin = self.binary_path
+
+        data_dir = self._get_data_dir(db_version)
+        sudo('rm -rf %s/*' % data_dir)
+        with hide('running'):
+            run('sudo su postgres -c "PGPASSWORD=%s %spg_basebackup -h %s '
+                '-p 5432 -U replicator -x -D %s"'
+                %(password, psql_bin, source_ip, data_dir))
+
+    def _finish_slave(self, db_version, data_dir, upstream_ip, password,
+                      encrypt=None):
+        config_dir = self._get_config_dir(db_version, data_dir)
 
         self._setup_postgres_config(config_dir, self.postgres_config)
         self._setup_archive_dir(data_dir)
-        self._setup_recovery_conf(master_ip, replicator_pass,
-                                  data_dir)
+        self._setup_recovery_conf(upstream_ip, password, data_dir)
         self._setup_hba_config(config_dir, encrypt)
 
         self._start_db_server(db_version)
+
+    def _setup_slaves(self, master, slaves, encrypt=None, source=None,
+                      upstream=None):
+        """
+        Sets up every host in slaves from a single base backup.
+
+        When the source is the master the backup is rsynced to all
+        slaves inside one pg_start_backup/pg_stop_backup window.
+        Otherwise every slave pulls its copy from the source slave
+        in parallel and the master isn't touched.
+        """
+        if not source:
+            source = master
+        if not upstream:
+            upstream = source
+
+        replicator_pass = self._get_replicator_pass()
+
+        with settings(host_string=master):
+            db_version = self._get_master_db_version()
+            if ((source != master or upstream != master) and
+                    not self._supports_cascading()):
+                print ("Seeding or streaming from a slave needs postgres "
+                       "9.2 or later, the master runs %s. Leave out "
+                       "source and upstream to use the master."
+                       % (facts.get_fact('psql_version') or self.db_version))
+                sys.exit(1)
+
+        upstream_ip = self._get_ip(upstream)
+
+        data_dirs = {}
+        for slave in slaves:
+            with settings(host_string=slave):
+                data_dirs[slave] = self._prepare_slave(master, source,
+                                                       db_version)
+
+        if source == master:
+            self._copy_from_master(master, data_dirs[slaves[0]], slaves)
+        else:
+            source_ip = self._get_ip(source)
+            execute(parallel(pool_size=None)(self._copy_from_slave), source_ip,
+                    replicator_pass, db_version, hosts=slaves)
+
+        for slave in slaves:
+            with settings(host_string=slave):
+                self._finish_slave(db_version, data_dirs[slave], upstream_ip,
+                                   replicator_pass, encrypt)
+
         print('password for replicator on master node is %s' % replicator_pass)
 
+    def run(self, master=None, encrypt=None, section=None, source=None,
+            upstream=None, **kwargs):
+        """
+        """
+        if not master:
+            print "Hey, a master is required for slave."
+            sys.exit(1)
+
+        self._setup_slaves(master, [env.host_string], encrypt=encrypt,
+                           source=source, upstream=upstream)
+
+class MultiSlaveSetup(SlaveSetup):
+    """
+    Set up several slaves with streaming replication at once
+
+    Every slave is built from the same base backup, so the master
+    only goes through one backup window no matter how many slaves
+    are added.
+
+    Takes the following arguments:
+
+    * **master**: Required. The connection string of the master db.
+
+    * **slaves**: Required. The connection strings of the new slaves
+                separated by semicolons.
+
+    * **source** and **upstream**: the same as ``postgres.slave_setup``.
+
+    This is a serial task, that should not be called with any remote
+    hosts as the hosts it runs on are given by its arguments.
+    """
+
+    name = 'multi_slave_setup'
+    serial = True
+
+    def run(self, master=None, slaves=None, encrypt=None, source=None,
+            upstream=None, **kwargs):
+        """
+        """
+        if not master or not slaves:
+            print "Hey, a master and at least one slave are required."
+            sys.exit(1)
+
+        slaves = [x.strip() for x in slaves.split(';') if x.strip()]
+        self._setup_slaves(master, slaves, encrypt=encrypt, source=source,
+                           upstream=upstream)
+
 class Backups(Task):
     path = '/backups/dbs'
     name = 'setup_backups'
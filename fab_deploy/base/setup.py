@@ -1,11 +1,13 @@
 import sys, os
-from fabric.api import task, run, sudo, execute, env, local, settings
+from fabric.api import task, run, sudo, execute, env, local, settings, hide
 from fabric.tasks import Task
+from fabric.decorators import parallel
 from fabric.contrib.files import append, sed, exists, contains
 from fabric.operations import get, put
 from fabric.context_managers import cd
 
 from fab_deploy import functions
+from fab_deploy.base import facts
 
 class BaseSetup(Task):
     """
@@ -15,6 +17,18 @@ class BaseSetup(Task):
 
     Sets up ssh so root cannot login and other logins must
     be key based.
+
+    Packages are installed in a single transaction, skipping the
+    ones already installed. The package index is only refreshed
+    when it is older than index_max_age minutes, which is checked
+    at the start of every setup. Set package_proxy, or package_proxy
+    in your env, to install through a local mirror or caching proxy.
+
+    Every step that completes is recorded in steps_file on the host
+    and in ~/.fab_deploy/steps locally. If a setup fails, running it
+    again skips the steps that already completed. The record is
+    removed once the setup finishes. Pass force_step with a
+    semicolon separated list of steps, or all, to run them again.
     """
 
     # Because setup tasks modify the config file
@@ -23,9 +37,154 @@ class BaseSetup(Task):
     setup_firewall = True
     setup_snmp = True
 
+    # Set by fleet.converge, which updates the local files
+    # shared by a section once instead of on every host.
+    coordinated = False
+
+    steps_file = '/var/tmp/fab-deploy-setup-steps'
+
+    index_stamp = '/var/tmp/fab-deploy-package-index'
+    index_max_age = 24 * 60
+    package_proxy = None
+
     def _set_profile(self):
         pass
 
+    def _get_local_steps_file(self):
+        directory = env.get('setup_steps_dir',
+                            os.path.join(os.path.expanduser('~'),
+                                         '.fab_deploy', 'steps'))
+        return os.path.join(directory, env.host_string)
+
+    def _read_local_steps(self):
+        path = self._get_local_steps_file()
+        if not os.path.exists(path):
+            return []
+        fp = open(path)
+        lines = [l.strip() for l in fp.readlines()]
+        fp.close()
+        return lines
+
+    def _write_local_steps(self, lines):
+        path = self._get_local_steps_file()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if lines:
+            fp = open(path, 'w')
+            fp.write(''.join(['%s\n' % l for l in lines]))
+            fp.close()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _load_steps(self, force_step=None):
+        """
+        Reads the steps of this task that already completed on
+        env.host_string, leaving out the ones in force_step.
+        """
+        prefix = '%s:' % self.name
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = run('cat %s' % self.steps_file)
+
+        done = []
+        if not output.failed:
+            done = [l.strip()[len(prefix):] for l in output.splitlines()
+                    if l.strip().startswith(prefix)]
+
+        local_done = [l[len(prefix):] for l in self._read_local_steps()
+                      if l.startswith(prefix)]
+        if local_done and not done:
+            print ("%s has no record of the steps completed before, "
+                   "starting over" % env.host_string)
+            self._clear_local_steps()
+
+        forced = [s.strip() for s in (force_step or '').split(';')
+                  if s.strip()]
+        if 'all' in forced:
+            done = []
+        self._done_steps = set(done) - set(forced)
+
+    def _step(self, step, func, *args, **kwargs):
+        """
+        Calls func unless step already completed on env.host_string,
+        and records it once it has.
+        """
+        if step in self._done_steps:
+            print "Skipping %s, it completed before" % step
+            return None
+
+        result = func(*args, **kwargs)
+
+        line = '%s:%s' % (self.name, step)
+        run('echo %s >> %s' % (line, self.steps_file))
+        lines = self._read_local_steps()
+        lines.append(line)
+        self._write_local_steps(lines)
+        return result
+
+    def _clear_local_steps(self):
+        prefix = '%s:' % self.name
+        self._write_local_steps([l for l in self._read_local_steps()
+                                 if not l.startswith(prefix)])
+
+    def _clear_steps(self):
+        """
+        Removes the record of the steps of this task once it finished.
+        """
+        run("[ ! -f %(path)s ] || (grep -v '^%(name)s:' %(path)s > "
+            "%(path)s.tmp; mv %(path)s.tmp %(path)s)"
+            % {'path': self.steps_file, 'name': self.name})
+        self._clear_local_steps()
+        self._done_steps = set()
+
+    def _get_package_proxy(self):
+        return self.package_proxy or env.get('package_proxy')
+
+    def _setup_package_proxy(self, proxy):
+        pass
+
+    def _installed_packages_command(self, packages):
+        """
+        Returns a command that prints the names of the
+        given packages that are installed.
+        """
+        raise NotImplementedError()
+
+    def _update_index_command(self):
+        return None
+
+    def _install_packages_command(self, packages):
+        raise NotImplementedError()
+
+    def _get_installed_packages(self, packages):
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = run(self._installed_packages_command(packages))
+        return output.split()
+
+    def _update_index(self):
+        proxy = self._get_package_proxy()
+        if proxy:
+            self._setup_package_proxy(proxy)
+
+        command = self._update_index_command()
+        if command:
+            sudo('[ -n "`find %s -mmin -%s 2>/dev/null`" ] || '
+                 '(%s && touch %s)' % (self.index_stamp, self.index_max_age,
+                                       command, self.index_stamp))
+
+    def _install_package_list(self, packages):
+        """
+        Installs the packages that aren't installed yet
+        in one transaction.
+        """
+        installed = self._get_installed_packages(packages)
+        missing = [p for p in packages if not p in installed]
+        if not missing:
+            return
+
+        self._update_index()
+        sudo(self._install_packages_command(missing))
+        facts.clear_facts()
+
     def _is_section_exists(self, section):
         if env.config_object.has_section(section):
             return True
@@ -58,8 +217,7 @@ class BaseSetup(Task):
 
             ips = env.config_object.get_list(config_section,
                                 env.config_object.INTERNAL_IPS)
-            results = execute('utils.get_ip', None, hosts=[env.host_string])
-            internal_ip = results[env.host_string]
+            internal_ip = facts.get_fact('ip')
             ips.append(internal_ip)
 
             env.config_object.set_list(config_section,
@@ -72,7 +230,8 @@ class BaseSetup(Task):
 
     def _add_snmp(self, config_section):
         if self.setup_snmp:
-            execute('snmp.update_files', section=config_section)
+            if not self.coordinated:
+                execute('snmp.update_files', section=config_section)
             task = functions.get_task_instance('snmp.update_files')
             filename = task.get_section_path(config_section)
             execute('snmp.sync_single', filename=filename)
@@ -90,12 +249,16 @@ class BaseSetup(Task):
     def _update_firewalls(self, config_section):
         if self.setup_firewall:
             # Generate the correct file
-            execute('firewall.update_files', section=config_section)
+            if not self.coordinated:
+                execute('firewall.update_files', section=config_section)
 
             task = functions.get_task_instance('firewall.update_files')
             filename = task.get_section_path(config_section)
             execute('firewall.sync_single', filename=filename)
 
+            if self.coordinated:
+                return
+
             # Update any section where this section appears
             for section in env.config_object.server_sections():
                 if config_section in env.config_object.get_list(section,
@@ -139,30 +302,47 @@ class LBSetup(BaseSetup):
         execute('nginx.update_allowed_ips', nginx_conf=task.nginx_conf,
                             section=self.config_section)
 
+        if functions.get_task_instance('nginx.update_proxy_cache'):
+            execute('nginx.update_proxy_cache', nginx_conf=self.nginx_conf,
+                            section=self.config_section)
+
     def _transfer_files(self):
         execute('git.setup', branch=self.git_branch, hook=self.git_hook)
         execute('local.git.push', branch=self.git_branch)
         execute('local.git.reset_remote')
 
-    def run(self, name=None):
-        self._secure_ssh()
-        self._set_profile()
+        # With releases the hook doesn't check out the code
+        deploy = functions.get_task_instance('local.deploy.do')
+        if getattr(deploy, 'use_releases', False):
+            commit = functions.get_commit(self.git_branch)
+            release = deploy._create_release(commit)
+            run('touch %s' % os.path.join(release, deploy.release_marker))
+            deploy._activate_release(release)
+
+    def run(self, name=None, force_step=None):
+        self._load_steps(force_step)
+        # Other tasks install packages outside of the package list
+        self._update_index()
+        self._step('secure_ssh', self._secure_ssh)
+        self._step('set_profile', self._set_profile)
 
         self._update_config(self.config_section)
 
         self._add_remote(name=name)
 
         # Transfer files first so all configs are in place.
-        self._transfer_files()
-        self._install_packages()
-        self._setup_services()
-        self._add_snmp(self.config_section)
-        self._update_firewalls(self.config_section)
+        self._step('transfer_files', self._transfer_files)
+        self._step('install_packages', self._install_packages)
+        self._step('setup_services', self._setup_services)
+        self._step('snmp', self._add_snmp, self.config_section)
+        self._step('firewall', self._update_firewalls, self.config_section)
         self._save_config()
 
-        execute('deploy', branch=self.git_branch)
+        self._step('deploy', execute, 'deploy', branch=self.git_branch)
 
-        self._modify_others()
+        if not self.coordinated:
+            self._modify_others()
+        self._clear_steps()
 
     def _setup_services(self):
         execute('nginx.setup', nginx_conf=self.nginx_conf)
@@ -176,6 +356,15 @@ class AppSetup(LBSetup):
     Also installs gunicorn, python, and other base packages.
     Runs the scripts/setup.sh script.
 
+    The hash of the requirements the virtualenv was built from is
+    recorded on the host, and the build is skipped when it matches.
+    With venv_artifacts set, a virtualenv is only built on the first
+    app server for each hash. Other servers get a compressed copy
+    streamed from one that has it over the internal network. This
+    needs your ssh agent to hold the key for the servers. Servers
+    that can't be reached are skipped, and the virtualenv is built
+    when no server has it or the copy fails.
+
     Once finished it calls ``nginx.update_app_servers``
 
     This is a serial task as it modifies local config files.
@@ -190,6 +379,9 @@ class AppSetup(LBSetup):
 
     packages = []
 
+    setup_args = 'production'
+    venv_artifacts = False
+
     def _set_profile(self):
         super(AppSetup, self)._set_profile()
         if self.settings_host and env.project_env_var:
@@ -206,9 +398,67 @@ class AppSetup(LBSetup):
     def _install_packages(self):
         raise NotImplementedError()
 
-    def _install_venv(self):
+    def _set_venv_hash(self, req_hash):
+        path = os.path.join(env.git_working_dir,
+                            functions.REQUIREMENTS_HASH_FILE)
+        run('echo %s > %s' % (req_hash, path))
+
+    def _build_venv(self):
         sudo('pip install virtualenv')
-        run('sh %s/scripts/setup.sh production' % env.git_working_dir)
+        run('sh %s/scripts/setup.sh %s' % (env.git_working_dir,
+                                           self.setup_args))
+
+    def _find_venv_peer(self, req_hash):
+        """
+        Returns the internal ip of another server in this
+        section whose virtualenv was built from req_hash.
+        """
+        conf = env.config_object
+        connections = conf.get_list(self.config_section, conf.CONNECTIONS)
+        ips = conf.get_list(self.config_section, conf.INTERNAL_IPS)
+        peers = [c for c in connections if c != env.host_string]
+        if not peers or len(ips) != len(connections):
+            return None
+
+        # A peer that can't be reached just isn't used
+        with settings(hide('warnings'), warn_only=True,
+                      skip_bad_hosts=True):
+            results = execute(parallel(pool_size=None)(
+                                functions.get_installed_requirements_hash),
+                              hosts=peers)
+        for peer in peers:
+            if results.get(peer) == req_hash:
+                user = peer.split('@')[0]
+                return '%s@%s' % (user, ips[connections.index(peer)])
+        return None
+
+    def _copy_venv(self, peer):
+        """
+        Copies the virtualenv of peer, returns False if that fails.
+        """
+        with settings(warn_only=True):
+            result = local('ssh -A %s "ssh -o StrictHostKeyChecking=no %s '
+                           '\'tar -czf - -C %s env\' | tar -xzf - -C %s"'
+                           % (env.host_string, peer, env.git_working_dir,
+                              env.git_working_dir))
+        if result.failed:
+            print "Couldn't copy the virtualenv of %s, building it" % peer
+            run('rm -rf %s' % os.path.join(env.git_working_dir, 'env'))
+        return result.succeeded
+
+    def _install_venv(self):
+        req_hash = functions.get_requirements_hash(self.git_branch)
+        if functions.get_installed_requirements_hash() == req_hash:
+            print "virtualenv is up to date, skipping"
+            return
+
+        peer = None
+        if self.venv_artifacts:
+            peer = self._find_venv_peer(req_hash)
+
+        if not peer or not self._copy_venv(peer):
+            self._build_venv()
+        self._set_venv_hash(req_hash)
 
     def _setup_services(self):
         super(AppSetup, self)._setup_services()
@@ -222,20 +472,32 @@ class DBSetup(BaseSetup):
     name = 'db_server'
     config_section = 'db-server'
 
-    def run(self, name=None):
-        self._secure_ssh()
-        self._set_profile()
+    def run(self, name=None, force_step=None):
+        self._load_steps(force_step)
+        # Other tasks install packages outside of the package list
+        self._update_index()
+        self._step('secure_ssh', self._secure_ssh)
+        self._step('set_profile', self._set_profile)
 
         self._update_config(self.config_section)
-        self._add_snmp(self.config_section)
-        self._update_firewalls(self.config_section)
-        dict = execute('postgres.master_setup', section=self.config_section,
-                       save_config=True)
+        self._step('snmp', self._add_snmp, self.config_section)
+        self._step('firewall', self._update_firewalls, self.config_section)
+        self._step('postgres', execute, 'postgres.master_setup',
+                   section=self.config_section, save_config=True)
         self._save_config()
+        self._clear_steps()
 
 class SlaveSetup(DBSetup):
     """
     Set up a slave database server with streaming replication
+
+    Takes the following optional arguments:
+
+    * **source**: The connection string of an existing slave to copy
+                the base backup from instead of the master.
+
+    * **upstream**: The connection string of the server to stream
+                  from. Defaults to the source.
     """
     name = 'slave_db'
     config_section = 'slave-db'
@@ -265,26 +527,41 @@ class SlaveSetup(DBSetup):
 
         return master
 
-    def run(self, name=None):
+    def run(self, name=None, source=None, upstream=None, force_step=None):
         """
         """
-        self._secure_ssh()
-        self._set_profile()
+        self._load_steps(force_step)
+        # Other tasks install packages outside of the package list
+        self._update_index()
+        self._step('secure_ssh', self._secure_ssh)
+        self._step('set_profile', self._set_profile)
 
         self._update_config(self.config_section)
         master = self._get_master()
-        self._add_snmp(self.config_section)
-        self._update_firewalls(self.config_section)
-        execute('postgres.slave_setup', master=master,
-                section=self.config_section)
+        self._step('snmp', self._add_snmp, self.config_section)
+        self._step('firewall', self._update_firewalls, self.config_section)
+        self._step('postgres', execute, 'postgres.slave_setup', master=master,
+                   section=self.config_section, source=source,
+                   upstream=upstream)
         self._save_config()
 
-        # update firewall for db-server
+        # update firewall for db-server and any slave
+        # this one is copied from or streams from
         task = functions.get_task_instance('firewall.update_files')
         if task:
             filename = task.get_section_path('db-server')
             execute('firewall.sync_single', filename=filename, hosts=[master])
 
+            for host in set([source, upstream]):
+                if host and host != master:
+                    section = env.config_object.get_host_section(host)
+                    if section:
+                        filename = task.get_section_path(section)
+                        execute('firewall.sync_single', filename=filename,
+                                hosts=[host])
+
+        self._clear_steps()
+
 class DevSetup(AppSetup):
     """
     Setup a development server
@@ -293,14 +570,11 @@ class DevSetup(AppSetup):
     config_section = 'dev-server'
     settings_host = config_section
     git_branch = 'develop'
+    setup_args = 'production development'
 
     def _modify_others(self):
         pass
 
-    def _install_venv(self):
-        sudo('pip install virtualenv')
-        run('sh %s/scripts/setup.sh production development' % env.git_working_dir)
-
     def _setup_services(self):
         super(DevSetup, self)._setup_services()
         execute('postgres.master_setup', section=self.config_section)
@@ -317,9 +591,18 @@ class Control(Task):
     def restart(self):
         raise NotImplementedError()
 
-    def run(self, start=True, restart=False, stop=False, hosts=[]):
+    def reload(self):
+        """
+        Services that can't reload gracefully are restarted.
+        """
+        self.restart()
+
+    def run(self, start=True, restart=False, stop=False, reload=False,
+            hosts=[]):
         if stop:
             self.stop()
+        elif reload:
+            self.reload()
         elif restart:
             self.restart()
         else:
@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import traceback
+
+from fabric.api import env, task, settings, hide
+from fabric.decorators import runs_once
+
+from fab_deploy import functions
+from fab_deploy.config import CustomConfig
+from fab_deploy.plan import Recorder
+
+# Name, share of the hosts and options of the synthesized sections
+SECTIONS = (
+    ('app-server', 0.6, {
+        'allowed-sections': 'load-balancer',
+        'open-ports': '80',
+        'restricted-ports': '8000'}),
+    ('load-balancer', 0.05, {
+        'open-ports': '80,443'}),
+    ('db-server', 0.05, {
+        'allowed-sections': 'app-server,db-server,slave-db',
+        'restricted-ports': '5432'}),
+    ('slave-db', 0.1, {
+        'allowed-sections': 'app-server,db-server,slave-db',
+        'restricted-ports': '5432'}),
+    ('cache-server', 0.2, {
+        'allowed-sections': 'app-server',
+        'restricted-ports': '11211',
+        'udp-allowed-sections': 'app-server',
+        'udp-restricted-ports': '11211'}),
+)
+
+# Task, arguments and nginx config the generators update
+GENERATORS = (
+    ('firewall.update_files', {}, None),
+    ('snmp.update_files', {}, None),
+    ('nginx.update_app_servers', {'section': 'app-server'},
+     'nginx/nginx-lb.conf'),
+    ('nginx.update_allowed_ips', {'section': 'load-balancer'},
+     'nginx/nginx.conf'),
+)
+
+def build_config(hosts):
+    """
+    Returns a CustomConfig with hosts spread over SECTIONS,
+    and a monitor section for snmp.
+    """
+    conf = CustomConfig()
+    counts = [max(int(hosts * share), 1) for name, share, options in SECTIONS]
+    counts[0] += max(hosts - sum(counts), 0)
+
+    n = 0
+    for (section, share, options), count in zip(SECTIONS, counts):
+        conf.add_section(section)
+        connections = []
+        ips = []
+        for i in range(count):
+            n += 1
+            connections.append('admin@10.%s.%s.%s' % (n / 65536,
+                                                      n / 256 % 256, n % 256))
+            ips.append('192.168.%s.%s' % (n / 256 % 256, n % 256))
+        conf.set_list(section, conf.CONNECTIONS, connections)
+        conf.set_list(section, conf.INTERNAL_IPS, ips)
+        for key, value in options.items():
+            conf.set(section, key, value)
+
+    conf.add_section('monitor')
+    conf.set('monitor', 'is_server', 'false')
+    conf.set('monitor', 'community', 'public')
+    conf.set_list('monitor', conf.CONNECTIONS, ['admin@10.255.255.1'])
+    conf.set_list('monitor', conf.INTERNAL_IPS, ['192.168.255.1'])
+    return conf
+
+def _write_nginx_conf(deploy_path, nginx_conf, task):
+    path = os.path.join(deploy_path, nginx_conf)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fp = open(path, 'a')
+    fp.write('%s\n%s\n' % (task.START_DELM, task.END_DELM))
+    fp.close()
+
+def _snapshot(path):
+    files = {}
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            filename = os.path.join(root, name)
+            stat = os.stat(filename)
+            files[filename] = (stat.st_size, stat.st_mtime)
+    return files
+
+def _run_child(func, recorder):
+    """
+    Runs func in a forked process. Returns the seconds it took,
+    the kinds of the commands it recorded and the rusage of the
+    process, which includes the subprocesses it waited for.
+    """
+    sys.stdout.flush()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            recorder.steps = []
+            start = time.time()
+            try:
+                func()
+                result = {'seconds': time.time() - start,
+                          'kinds': [step[1] for step in recorder.steps]}
+            except BaseException:
+                result = {'error': traceback.format_exc()}
+                status = 1
+            data = json.dumps(result)
+            while data:
+                data = data[os.write(write_fd, data):]
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+
+    os.close(write_fd)
+    chunks = []
+    while True:
+        data = os.read(read_fd, 65536)
+        if not data:
+            break
+        chunks.append(data)
+    os.close(read_fd)
+    __, status, usage = os.wait4(pid, 0)
+
+    result = chunks and json.loads(''.join(chunks)) or {}
+    if status or not 'seconds' in result:
+        print result.get('error', 'The benchmark process exited with %s'
+                                  % status)
+        sys.exit(1)
+    return result['seconds'], result['kinds'], usage
+
+def _measure(name, hosts, func, recorder, deploy_path):
+    before = _snapshot(deploy_path)
+    seconds, kinds, usage = _run_child(func, recorder)
+
+    after = _snapshot(deploy_path)
+    output = sum([after[f][0] for f in after if after[f] != before.get(f)])
+
+    return {
+        'generator': name,
+        'hosts': hosts,
+        'seconds': round(seconds, 4),
+        'peak_rss_kb': usage.ru_maxrss,
+        'subprocesses': len([k for k in kinds if k.startswith('local')]),
+        'failed_subprocesses': kinds.count('local failed'),
+        'output_bytes': output,
+    }
+
+def run_benchmark(hosts, recorder):
+    """
+    Times reading and writing a config with hosts hosts and
+    every generator that exists for the loaded platform.
+    """
+    results = []
+    deploy_path = tempfile.mkdtemp()
+    filename = os.path.join(deploy_path, 'servers.ini')
+    try:
+        config = build_config(hosts)
+
+        env.deploy_path = deploy_path
+        results.append(_measure('config.save', hosts,
+                                lambda: config.save(filename),
+                                recorder, deploy_path))
+
+        env.config_object = CustomConfig()
+        results.append(_measure('config.read', hosts,
+                                lambda: env.config_object.read([filename]),
+                                recorder, deploy_path))
+        # The generators need the config read here, not in the child
+        env.config_object.read([filename])
+
+        for name, kwargs, nginx_conf in GENERATORS:
+            task = functions.get_task_instance(name)
+            if not task:
+                continue
+            if nginx_conf:
+                _write_nginx_conf(deploy_path, nginx_conf, task)
+                kwargs = dict(kwargs, nginx_conf=nginx_conf)
+            results.append(_measure(name, hosts,
+                                    lambda: task.run(**kwargs),
+                                    recorder, deploy_path))
+    finally:
+        shutil.rmtree(deploy_path, ignore_errors=True)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a line for every generator that got slower
+    than tolerance times its time in baseline.
+    """
+    old = dict([((r['generator'], r['hosts']), r) for r in baseline])
+    regressions = []
+    for result in results:
+        before = old.get((result['generator'], result['hosts']))
+        if not before or not before['seconds']:
+            continue
+        ratio = result['seconds'] / before['seconds']
+        if ratio > tolerance:
+            regressions.append("%s with %s hosts: %.4fs, was %.4fs (%.2fx)"
+                               % (result['generator'], result['hosts'],
+                                  result['seconds'], before['seconds'],
+                                  ratio))
+    return regressions
+
+@task(hosts=[])
+@runs_once
+def benchmark(sizes='10;100;1000;10000', save=None, baseline=None,
+              tolerance='1.25'):
+    """
+    Benchmark the config generators with synthesized inventories.
+
+    For every size a servers.ini with that many hosts is spread over
+    app servers, load balancers, a db server with slaves and cache
+    servers that allow each other. Then the config is written and
+    read back, and the firewall, snmp and nginx generators that exist
+    for your platform run on it in a temporary deploy directory.
+    Remote calls are recorded instead of run. Each step runs in a
+    process of its own.
+
+    Prints the seconds, peak memory of the process running the step
+    and its subprocesses, subprocesses started (and how many failed)
+    and bytes written per generator.
+
+    Takes the following optional arguments:
+
+    * **sizes**: Semicolon separated host counts.
+
+    * **save**: The file to write the results to as json.
+
+    * **baseline**: Results saved before. Every generator that got
+                  slower than tolerance times its baseline is listed
+                  and the task fails.
+
+    * **tolerance**: The allowed slow down, 1.25 by default.
+    """
+
+    saved = dict([(k, env.get(k)) for k in ('deploy_path', 'config_object')])
+
+    results = []
+    recorder = Recorder(run_local=True)
+    recorder.start()
+    try:
+        with settings(hide('running', 'output', 'warnings')):
+            for size in sizes.split(';'):
+                if size.strip():
+                    results.extend(run_benchmark(int(size), recorder))
+    finally:
+        recorder.stop()
+        env.update(saved)
+
+    print "%-26s %6s %9s %9s %6s %6s %10s" % ('generator', 'hosts', 'seconds',
+                                              'rss kb', 'procs', 'failed',
+                                              'bytes')
+    for r in results:
+        print "%-26s %6s %9.4f %9s %6s %6s %10s" % (r['generator'], r['hosts'],
+                                                r['seconds'], r['peak_rss_kb'],
+                                                r['subprocesses'],
+                                                r['failed_subprocesses'],
+                                                r['output_bytes'])
+
+    if save:
+        fp = open(save, 'w')
+        json.dump(results, fp, indent=1, sort_keys=True)
+        fp.close()
+
+    if baseline:
+        fp = open(baseline)
+        regressions = compare(results, json.load(fp), float(tolerance))
+        fp.close()
+        if regressions:
+            print
+            print "Slower than %s:" % baseline
+            for line in regressions:
+                print line
+            sys.exit(1)
@@ -1,8 +1,20 @@
+import os
+import fcntl
+import hashlib
+import atexit
 import ConfigParser
 
 class CustomConfig(ConfigParser.ConfigParser):
     """
     Custom Config class that can read and write lists.
+
+    Changes are recorded, and save merges them into the file as
+    it is on disk while holding a lock on it, so processes that
+    change different sections don't overwrite each other.
+
+    After write_behind is called save only remembers the filename
+    and the changes are written once when the process exits, or
+    when flush is called.
     """
 
     # Config settings
@@ -31,10 +43,62 @@ class CustomConfig(ConfigParser.ConfigParser):
     # GIT
     GIT_SYNC = 'git-sync'
 
+    # Gunicorn
+    WORKERS = 'workers'
+    WORKER_CLASS = 'worker-class'
+    THREADS = 'threads'
+    MAX_REQUESTS = 'max-requests'
+    MAX_REQUESTS_JITTER = 'max-requests-jitter'
+    BACKLOG = 'backlog'
+
+    # Recorded per host as host=value pairs
+    HOST_CORES = 'host-cores'
+    HOST_MEMORY = 'host-memory'
+    HOST_WORKERS = 'host-workers'
+
+    # Nginx
+    LB_METHOD = 'lb-method'
+    UPSTREAM_KEEPALIVE = 'upstream-keepalive'
+    CACHE_ZONE_SIZE = 'cache-zone-size'
+    CACHE_MAX_SIZE = 'cache-max-size'
+    CACHE_TTL = 'cache-ttl'
+    CACHE_LOCATIONS = 'cache-locations'
+    CACHE_BYPASS_COOKIES = 'cache-bypass-cookies'
+    CACHE_UPSTREAM = 'cache-upstream'
+
+    # Fleet
+    SETUP_TASK = 'setup-task'
+    DEPENDS_ON = 'depends-on'
+
+    # Deploy
+    MIGRATE_HOST = 'migrate-host'
+
     # Amazon
     EC2_KEY_NAME = 'ec2-key-name'
     EC2_KEY_FILE = 'ec2-key-file'
 
+    def __init__(self, *args, **kwargs):
+        ConfigParser.ConfigParser.__init__(self, *args, **kwargs)
+        self._changes = []
+        self._pending = None
+        self._write_behind_pid = None
+
+    def add_section(self, section):
+        self._changes.append(('add_section', section))
+        ConfigParser.ConfigParser.add_section(self, section)
+
+    def remove_section(self, section):
+        self._changes.append(('remove_section', section))
+        return ConfigParser.ConfigParser.remove_section(self, section)
+
+    def set(self, section, option, value=None):
+        self._changes.append(('set', section, option, value))
+        ConfigParser.ConfigParser.set(self, section, option, value)
+
+    def remove_option(self, section, option):
+        self._changes.append(('remove_option', section, option))
+        return ConfigParser.ConfigParser.remove_option(self, section, option)
+
     def get_list(self, section, key):
         """
         """
@@ -49,12 +113,130 @@ class CustomConfig(ConfigParser.ConfigParser):
         t = ','.join(slist)
         self.set(section, key, t)
 
+    def get_dict(self, section, key):
+        """
+        Reads a list of key=value pairs into a dict.
+        """
+        result = {}
+        for item in self.get_list(section, key):
+            k, sep, v = item.rpartition('=')
+            if sep:
+                result[k.strip()] = v.strip()
+        return result
+
+    def set_dict(self, section, key, sdict):
+        """
+        """
+        self.set_list(section, key,
+                    ['%s=%s' % (k, sdict[k]) for k in sorted(sdict)])
+
+    def get_host_section(self, host):
+        """
+        Returns the first server section that has host in its
+        connections or None.
+        """
+        for section in self.server_sections():
+            if host in self.get_list(section, self.CONNECTIONS):
+                return section
+        return None
+
+    def pop_changes(self):
+        """
+        Returns the changes that haven't been written yet
+        and forgets them.
+        """
+        changes, self._changes = self._changes, []
+        self._pending = None
+        return changes
+
+    def apply_changes(self, changes):
+        """
+        Replays changes returned by pop_changes of another config.
+        """
+        for change in changes:
+            action, section = change[0], change[1]
+            if action == 'add_section':
+                if not self.has_section(section):
+                    self.add_section(section)
+            elif action == 'remove_section':
+                self.remove_section(section)
+            elif action == 'set':
+                if not self.has_section(section):
+                    self.add_section(section)
+                self.set(section, change[2], change[3])
+            elif self.has_section(section):
+                self.remove_option(section, change[2])
+
+    def _get_lock_file(self, filename):
+        """
+        The lock is kept in ~/.fab_deploy rather than next to
+        filename, so it doesn't show up in the project.
+        """
+        directory = os.path.join(os.path.expanduser('~'), '.fab_deploy',
+                                 'locks')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        digest = hashlib.md5(os.path.abspath(filename)).hexdigest()
+        return os.path.join(directory, '%s.lock' % digest)
+
+    def _write_file(self, filename):
+        lock = open(self._get_lock_file(filename), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            config = CustomConfig()
+            config.read([filename])
+            config.apply_changes(self._changes)
+
+            # Write to a temporary file that is renamed over filename,
+            # so a failure never leaves a truncated config behind.
+            tmp_filename = '%s.%s.tmp' % (filename, os.getpid())
+            fp = open(tmp_filename, 'w')
+            try:
+                config.write(fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+                fp.close()
+                os.rename(tmp_filename, filename)
+            except:
+                fp.close()
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+                raise
+
+            self._changes = []
+            # Pick up what other processes changed, including
+            # the sections and options they removed
+            self._sections = self._dict()
+            self.read([filename])
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def write_behind(self):
+        """
+        Buffers saves until the process exits or flush is called.
+        """
+        if not self._write_behind_pid:
+            atexit.register(self.flush)
+        self._write_behind_pid = os.getpid()
+
+    def flush(self):
+        """
+        Writes the buffered changes if there are any.
+        """
+        if self._pending:
+            filename, self._pending = self._pending, None
+            self._write_file(filename)
+
     def save(self, filename):
         """
         """
-        fp = open(filename, 'w')
-        self.write(fp)
-        fp.close()
+        # Processes forked by parallel tasks don't run the exit
+        # handlers, so they always write right away.
+        if self._write_behind_pid == os.getpid():
+            self._pending = filename
+        else:
+            self._write_file(filename)
 
     def server_sections(self, include_other=False):
         sections = self.sections()
@@ -0,0 +1,45 @@
+#!/bin/sh
+#
+# Installs the requirements of a branch into the project's virtualenv,
+# unless it was already installed from the same requirements files.
+#
+# Call it from your post-receive hook instead of running pip directly:
+#
+#   hooks/install-requirements <git dir> <working dir> <branch> [find links]
+#
+# When find links is given packages are only installed from that wheel
+# cache and never from PyPI. Requirements that are already satisfied
+# are left alone so only changed packages are installed.
+#
+# pip is run with the virtualenv's python so a working dir that isn't
+# active yet, like a new release, gets the packages.
+
+GIT_REPO=$1
+WORKING_DIR=$2
+BRANCH=${3:-master}
+FIND_LINKS=$4
+
+HASH_FILE=$WORKING_DIR/env/.requirements-hash
+PYTHON=python
+if [ -x $WORKING_DIR/env/bin/python ]; then
+    PYTHON=$WORKING_DIR/env/bin/python
+fi
+
+# Must match fab_deploy.functions.get_requirements_hash
+NEW_HASH=`git --git-dir=$GIT_REPO ls-tree -r $BRANCH -- requirements.txt \
+    requirements scripts/setup.sh | \
+    $PYTHON -c "import sys, hashlib; print(hashlib.sha1(sys.stdin.read().encode()).hexdigest())"`
+
+if [ -f $HASH_FILE ] && [ "`cat $HASH_FILE`" = "$NEW_HASH" ]; then
+    echo "Requirements unchanged, skipping install"
+    exit 0
+fi
+
+if [ -n "$FIND_LINKS" ]; then
+    $PYTHON -m pip install --no-index --find-links $FIND_LINKS \
+        -r $WORKING_DIR/requirements.txt || exit 1
+else
+    $PYTHON -m pip install -r $WORKING_DIR/requirements.txt || exit 1
+fi
+
+echo $NEW_HASH > $HASH_FILE
@@ -1,42 +1,444 @@
 import os
+import sys
+import time
+import socket
+import getpass
 
-from fabric.api import local, env, execute, task, cd, run
-from fabric.decorators import runs_once
+from fabric.api import local, env, execute, task, cd, run, settings, hide
+from fabric.decorators import runs_once, parallel
+
+from fab_deploy import functions
+
+# Held on the migrate host of a section while migrations run
+MIGRATE_LOCK = '.fab-deploy-migrate.lock'
+# Where the hash of the last migrated files is kept on that host
+MIGRATIONS_HASH_FILE = '.fab-deploy-migrations'
+MIGRATE_TIMEOUT = 600
+# Seconds after which a lock left by a killed deploy can be broken
+MIGRATE_LOCK_TTL = 2 * 60 * 60
+
+# How much slower than the old app servers the canaries may be
+CANARY_THRESHOLD = 1.2
+# How much higher their server error rate may be
+CANARY_ERROR_MARGIN = 0.01
+# Requests both groups need in the window to be compared
+CANARY_MIN_REQUESTS = 100
+PERCENTILES = (50, 95, 99)
+
+def _timed(name, func, *args, **kwargs):
+    """
+    Calls func and adds the seconds it took to env.deploy_timings.
+    """
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings = env.get('deploy_timings', [])
+        timings.append((name, time.time() - start))
+        env.deploy_timings = timings
+
+def print_timings():
+    for name, seconds in env.get('deploy_timings', []):
+        print "%-40s %8.1fs" % (name, seconds)
+
+def _push_hosts(deploy_task, branch, hosts):
+    """
+    Pushes the code of branch to hosts at once with
+    ``local.git.push_many``. Without releases the static files
+    are synced to them first, as their post-receive hooks put
+    the new code live.
+    """
+    if len(hosts) < 2:
+        return
+
+    if not getattr(deploy_task, 'use_releases', False):
+        with settings(pool_size=env.pool_size or 20):
+            results = execute(parallel(pool_size=None)(
+                                deploy_task._presync_static),
+                              branch, hosts=hosts)
+        env.static_synced = env.get('static_synced', []) + [
+                                            h for h in hosts if results.get(h)]
+    task = functions.get_task_instance('local.git.push_many')
+    task.push(branch, hosts)
 
 @runs_once
-def pre_deploy(branch=None):
+def pre_deploy(branch=None, compress=None, canary=None):
     """
     Make sure that ``local.deploy.prep`` is only run
     once when the deploy command is run on multiple
     hosts.
+
+    Then the revision every host was last deployed with is
+    read in parallel, and hosts that already have the commit
+    and static files of branch are skipped by ``deploy``. The
+    code is pushed to the others at once with
+    ``local.git.push_many``, or the artifact is copied to
+    all of them in parallel when deploying artifacts. Without
+    releases the static files are synced to those hosts first, as
+    their post-receive hooks put the new code live.
+
+    For the same reason, when deploying to canary hosts first
+    without releases, only the canaries are pushed to here. The
+    others are held in env.deploy_held until ``check_canary``
+    passes.
     """
 
-    execute('local.deploy.prep', branch=branch, hosts=[env.host_string])
+    branch = branch or 'master'
+    deploy_task = functions.get_task_instance('local.deploy.do')
+    if (getattr(deploy_task, 'install_requirements', False) and
+            getattr(deploy_task, 'wheelhouse', None) and
+            not getattr(deploy_task, 'wheel_host', None)):
+        print ("wheelhouse is set but wheel_host isn't, set it to a "
+               "host like your servers to build the wheels on")
+        sys.exit(1)
+
+    execute('local.deploy.prep', branch=branch, compress=compress,
+            hosts=[env.host_string])
+
+    revision = deploy_task.get_revision(branch)
+    hosts = list(env.all_hosts)
+    with settings(warn_only=True, pool_size=env.pool_size or 20):
+        results = execute(parallel(pool_size=None)(deploy_task._get_deployed),
+                          hosts=hosts)
+
+    env.deploy_skip = [h for h in hosts if results.get(h) == revision]
+    behind = [h for h in hosts if not h in env.deploy_skip]
+    if env.deploy_skip:
+        print "%s of %s hosts are at %s already" % (len(env.deploy_skip),
+                                                    len(hosts), revision[:12])
+
+    if getattr(deploy_task, 'use_artifacts', False):
+        artifact = deploy_task.get_artifact(branch)
+        if artifact and behind:
+            with settings(pool_size=env.pool_size or 20):
+                execute(parallel(pool_size=None)(deploy_task._ship_artifact),
+                        artifact, hosts=behind)
+    else:
+        if (canary and len(hosts) > int(canary) and
+                not getattr(deploy_task, 'use_releases', False)):
+            canaries = hosts[:int(canary)]
+            env.deploy_held = [h for h in behind if not h in canaries]
+            behind = [h for h in behind if h in canaries]
+        _push_hosts(deploy_task, branch, behind)
 
 @task(hosts=[])
-def deploy(branch=None):
+def deploy(branch=None, reload=False, compress=None, purge=None,
+           migrate=False, canary=None, canary_window=300,
+           canary_threshold=None):
     """
     Deploy this project.
 
-    Internally calls local.deploy.prep once and then
-    ``local.deploy.do`` for each host.
+    Internally calls local.deploy.prep once, pushes the
+    code to all hosts at once and then calls
+    ``local.deploy.do`` for each host that isn't at the
+    branch's commit and static files already. So running a
+    deploy that failed on some hosts again only touches those.
 
     Takes an optional branch argument that can be used
     to deploy a branch other than master.
+
+    Pass reload=True to gracefully reload gunicorn on
+    each host once its code is pushed, and compress=gzip
+    or compress=brotli to precompress the static files.
+
+    Pass purge with a semicolon separated list of urls, or
+    all, to purge them from the load balancers' proxy cache
+    once the last host is deployed.
+
+    Pass migrate=True to run the migrations once the first
+    host is deployed, see ``migrate``.
+
+    Pass canary with a number of hosts to deploy to those first,
+    then compare the latency of their requests with that of the
+    other app servers for canary_window seconds, see
+    ``check_canary``. The deploy only goes on if the canaries are
+    at most canary_threshold times slower (1.2 by default).
+    Otherwise it stops, and with releases the canaries are rolled
+    back. Without releases the code is only pushed to the other
+    hosts once the canaries pass, as pushing puts it live.
+
+    Once the last host is deployed the time each step took
+    is printed.
     """
 
     if not env.get('deploy_ready', False):
-        pre_deploy(branch=branch)
+        _timed('pre_deploy', pre_deploy, branch=branch, compress=compress,
+               canary=canary)
         env.deploy_ready = True
-    execute('local.deploy.do', branch=branch, hosts=[env.host_string])
+
+    if env.host_string in env.get('deploy_skip', []):
+        print "Skipping %s, it is up to date" % env.host_string
+    else:
+        _timed('deploy %s' % env.host_string, execute, 'local.deploy.do',
+               branch=branch, reload=reload, hosts=[env.host_string])
+
+    if migrate and env.host_string == env.all_hosts[0]:
+        _timed('migrate', run_migrations, branch)
+
+    if canary and len(env.all_hosts) > int(canary):
+        canaries = env.all_hosts[:int(canary)]
+        if env.host_string == canaries[-1]:
+            failures = _timed('canary', check_canary, canaries,
+                              int(canary_window),
+                              float(canary_threshold or CANARY_THRESHOLD))
+            if failures:
+                _stop_canary(canaries, failures)
+            if env.get('deploy_held'):
+                deploy_task = functions.get_task_instance('local.deploy.do')
+                _timed('push', _push_hosts, deploy_task, branch or 'master',
+                       env.deploy_held)
+
+    if env.host_string == env.all_hosts[-1]:
+        if purge:
+            _timed('purge', purge_cache, purge)
+        print_timings()
 
 @task(hosts=[])
-def migrate():
+@runs_once
+def rollback(release=None):
     """
-    Database migration using south
+    Switch all hosts back to an earlier release.
+
+    Needs ``local.deploy.do`` to deploy with use_releases. Every
+    host given with -H or -R switches its active symlink to the
+    release deployed before the active one and reloads gunicorn
+    gracefully. All hosts do this at the same time, 20 at a time
+    unless fab's -z option is given.
+
+    Takes an optional release argument with the commit, or the
+    start of it, of the release to switch to instead. Run it
+    again to go back further.
+    """
+
+    deploy_task = functions.get_task_instance('local.deploy.do')
+    if not getattr(deploy_task, 'use_releases', False):
+        print "Rolling back needs local.deploy.do to use releases"
+        sys.exit(1)
+
+    hosts = list(env.all_hosts)
+    with settings(warn_only=True, pool_size=env.pool_size or 20):
+        results = execute(parallel(pool_size=None)(deploy_task._rollback),
+                          release, hosts=hosts)
+
+    failed = []
+    for host in hosts:
+        if isinstance(results.get(host), basestring):
+            print "%s is at %s" % (host, results[host])
+        else:
+            failed.append(host)
+    if failed:
+        print "Rolling back %s failed" % ', '.join(failed)
+        sys.exit(1)
+
+def get_percentiles(times, percentiles=PERCENTILES):
+    """
+    Returns the percentiles of times, a dict of milliseconds
+    to how many requests took that long.
     """
+    total = sum(times.values())
+    result = {}
+    count = 0
+    wanted = sorted(percentiles)
+    for ms in sorted(times):
+        count += times[ms]
+        while wanted and count * 100 >= wanted[0] * total:
+            result[wanted.pop(0)] = ms
+    return result
 
+def _merge_latency(results, addrs):
+    times = {}
+    errors = 0
+    for stats in results.values():
+        if not isinstance(stats, dict):
+            continue
+        for addr in addrs:
+            if addr in stats:
+                for ms, count in stats[addr]['times'].items():
+                    times[ms] = times.get(ms, 0) + count
+                errors += stats[addr]['errors']
+    return times, errors
+
+def check_canary(canaries, window=300, threshold=CANARY_THRESHOLD):
+    """
+    Waits window seconds, then compares the response times the
+    load balancers logged for the canaries with those of the other
+    app servers using ``nginx.latency``. Returns the reasons the
+    canaries failed, an empty list if they passed.
+    """
+    conf = env.config_object
+    lbs = conf.get_list('load-balancer', conf.CONNECTIONS)
+    if not lbs or not functions.get_task_instance('nginx.latency'):
+        return ["There are no load balancers to read the latency from"]
+
+    connections = conf.get_list('app-server', conf.CONNECTIONS)
+    ips = conf.get_list('app-server', conf.INTERNAL_IPS)
+    addrs = dict(zip(connections, ['%s:8000' % ip for ip in ips]))
+
+    print "Sampling latency for %s seconds" % window
+    time.sleep(window)
+    with settings(warn_only=True):
+        results = execute('nginx.latency', window=window, hosts=lbs)
+
+    groups = (
+        ('canary', [addrs[h] for h in canaries if h in addrs]),
+        ('old', [addrs[h] for h in connections if not h in canaries]),
+    )
+    summary = {}
+    print "%-8s %9s %8s %7s %7s %7s" % ('hosts', 'requests', 'errors',
+                                        'p50', 'p95', 'p99')
+    for name, group in groups:
+        times, errors = _merge_latency(results, group)
+        total = sum(times.values())
+        summary[name] = (total, errors, get_percentiles(times))
+        p = summary[name][2]
+        print "%-8s %9s %7.2f%% %5sms %5sms %5sms" % (name, total,
+                    total and 100.0 * errors / total or 0,
+                    p.get(50, '-'), p.get(95, '-'), p.get(99, '-'))
+
+    failures = []
+    for name, group in groups:
+        if summary[name][0] < CANARY_MIN_REQUESTS:
+            failures.append("The %s hosts served %s requests, %s are needed"
+                            % (name, summary[name][0], CANARY_MIN_REQUESTS))
+    if failures:
+        return failures
+
+    canary_total, canary_errors, canary_p = summary['canary']
+    old_total, old_errors, old_p = summary['old']
+    for percentile in PERCENTILES:
+        # A millisecond of slack so very fast pages don't fail on noise
+        if canary_p[percentile] > max(old_p[percentile] * threshold,
+                                      old_p[percentile] + 1):
+            failures.append("p%s is %sms, %sms on the old hosts"
+                            % (percentile, canary_p[percentile],
+                               old_p[percentile]))
+
+    canary_rate = float(canary_errors) / canary_total
+    old_rate = float(old_errors) / old_total
+    if canary_rate > old_rate + CANARY_ERROR_MARGIN:
+        failures.append("%.2f%% of the requests failed, %.2f%% on the old "
+                        "hosts" % (canary_rate * 100, old_rate * 100))
+    return failures
+
+def _stop_canary(canaries, failures):
+    for failure in failures:
+        print failure
+
+    deploy_task = functions.get_task_instance('local.deploy.do')
+    deployed = [h for h in canaries if not h in env.get('deploy_skip', [])]
+    if deployed and getattr(deploy_task, 'use_releases', False):
+        print "Rolling back %s" % ', '.join(deployed)
+        with settings(warn_only=True, pool_size=env.pool_size or 20):
+            execute(parallel(pool_size=None)(deploy_task._rollback),
+                    hosts=deployed)
+
+    print "The canaries failed, stopping the deploy"
+    sys.exit(1)
+
+def purge_cache(urls):
+    """
+    Purge urls from the proxy cache of every load balancer.
+    """
+    lbs = env.config_object.get_list('load-balancer',
+                                     env.config_object.CONNECTIONS)
+    if lbs and functions.get_task_instance('nginx.purge_cache'):
+        execute('nginx.purge_cache', urls=urls, hosts=lbs)
+
+def _get_migrate_host(host):
+    """
+    Returns the host that holds the migrate lock for host: the
+    migrate-host of its section in servers.ini, or the section's
+    first connection. So deploys to any hosts of a section wait
+    for each other.
+    """
+    conf = env.config_object
+    section = conf.get_host_section(host)
+    if not section:
+        return host
+    if conf.has_option(section, conf.MIGRATE_HOST):
+        return conf.get(section, conf.MIGRATE_HOST)
+    return conf.get_list(section, conf.CONNECTIONS)[0]
+
+def _lock_migrations(owner):
+    """
+    Takes the migrate lock on the current host, recording owner
+    and when the lock expires. An expired lock is broken.
+    """
+    run('i=0; until mkdir %(lock)s 2>/dev/null; do '
+        'expires=`cat %(lock)s/expires 2>/dev/null`; '
+        'if [ -n "$expires" ] && [ "$expires" -lt `date +%%s` ]; then '
+        'echo "Breaking the expired lock of `cat %(lock)s/owner`"; '
+        'rm -rf %(lock)s; continue; fi; '
+        'if [ $i -ge %(timeout)s ]; then echo "Timed out waiting for '
+        'the lock of `cat %(lock)s/owner 2>/dev/null`"; exit 1; fi; '
+        'sleep 1; i=`expr $i + 1`; done; '
+        'echo "%(owner)s" > %(lock)s/owner; '
+        'expr `date +%%s` + %(ttl)s > %(lock)s/expires' % {
+            'lock': MIGRATE_LOCK, 'timeout': MIGRATE_TIMEOUT,
+            'owner': owner, 'ttl': MIGRATE_LOCK_TTL})
+
+def _unlock_migrations(owner):
+    run('if [ "`cat %(lock)s/owner 2>/dev/null`" = "%(owner)s" ]; then '
+        'rm -rf %(lock)s; fi' % {'lock': MIGRATE_LOCK, 'owner': owner})
+
+def run_migrations(branch=None, host=None, force=False):
+    """
+    Runs the migrations on host, the first host given by default,
+    unless the migration files on branch are the ones that were
+    migrated last. The lock and the hash are kept on the migrate
+    host of its section. Returns True if migrations ran.
+    """
+    host = host or (env.all_hosts and env.all_hosts[0])
+    if not host:
+        print "There is no host to migrate on, pass one with -H or -R"
+        sys.exit(1)
+
+    lock_host = _get_migrate_host(host)
     manage_py = os.path.join(env.git_working_dir, 'project', 'manage.py')
     python_exe = os.path.join(env.git_working_dir, 'env', 'bin', 'python')
+    migrations_hash = functions.get_migrations_hash(branch or 'master')
+    owner = '%s@%s %s' % (getpass.getuser(), socket.gethostname(),
+                          os.getpid())
+
+    with settings(host_string=lock_host):
+        _lock_migrations(owner)
+    try:
+        if not force:
+            with settings(hide('running', 'output', 'warnings'),
+                          host_string=lock_host, warn_only=True):
+                output = run('cat %s' % MIGRATIONS_HASH_FILE)
+            if not output.failed and output.strip() == migrations_hash:
+                print "No pending migrations"
+                return False
+
+        with settings(host_string=host):
+            run('%s %s migrate --all' % (python_exe, manage_py))
+        with settings(host_string=lock_host):
+            run('echo %s > %s' % (migrations_hash, MIGRATIONS_HASH_FILE))
+    finally:
+        with settings(host_string=lock_host):
+            _unlock_migrations(owner)
+    return True
+
+@task(hosts=[])
+@runs_once
+def migrate(branch=None, force=False):
+    """
+    Database migration using south
+
+    The migrations run once, on the first host given with -H or
+    -R. A lock is held on the migrate host of its section, given
+    by the migrate-host option in server.ini or else the section's
+    first connection, so a migration started by another deploy
+    waits for this one. The lock records who holds it and expires
+    after two hours, so the lock of a killed deploy is broken.
+
+    A hash of the migration files on branch is recorded on the
+    migrate host, and when it matches the migrations are skipped
+    without starting django. Pass force=True to run them anyway.
+    """
 
-    run('%s %s migrate --all' %(python_exe, manage_py))
+    start = time.time()
+    ran = run_migrations(branch, force=force)
+    print "Migrations %s in %.1f seconds" % (ran and 'ran' or 'checked',
+                                             time.time() - start)
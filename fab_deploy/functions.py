@@ -2,8 +2,10 @@ import subprocess
 import urlparse
 import os
 import random
+import hashlib
+import tempfile
 
-from fabric.api import env
+from fabric.api import env, run, local, settings, hide
 from fabric.task_utils import crawl
 
 def get_answer(prompt):
@@ -48,6 +50,53 @@ def gather_remotes():
         remotes[parts[0]] = urlparse.urlparse(parts[1]).netloc
     return remotes
 
+# Files in your repo that decide what goes into the virtualenv
+REQUIREMENTS_FILES = ('requirements.txt', 'requirements', 'scripts/setup.sh')
+
+# Where the hash of the installed requirements is
+# recorded, relative to env.git_working_dir
+REQUIREMENTS_HASH_FILE = os.path.join('env', '.requirements-hash')
+
+def get_requirements_hash(branch='master'):
+    """
+    Returns a hash of the requirements files on branch in your repo.
+
+    The install-requirements hook computes the same hash on the
+    remote servers so both can skip installs that aren't needed.
+    """
+    files = call_command('git', 'ls-tree', '-r', branch, '--',
+                         *REQUIREMENTS_FILES)
+    return hashlib.sha1(files).hexdigest()
+
+def get_installed_requirements_hash(working_dir=None):
+    """
+    Returns the requirements hash recorded in the virtualenv of
+    working_dir on the current host, None if there is none.
+    """
+    path = os.path.join(working_dir or env.git_working_dir,
+                        REQUIREMENTS_HASH_FILE)
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        output = run('cat %s' % path)
+    if output.failed:
+        return None
+    return output.strip()
+
+def get_migrations_hash(branch='master'):
+    """
+    Returns a hash of the migration files on branch in your repo.
+    """
+    files = call_command('git', 'ls-tree', '-r', branch)
+    lines = [l for l in files.splitlines()
+             if '/migrations/' in l and l.endswith('.py')]
+    return hashlib.sha1('\n'.join(lines)).hexdigest()
+
+def get_commit(branch='master'):
+    """
+    Returns the commit branch points to in your repo.
+    """
+    return call_command('git', 'rev-parse', '--verify',
+                        '%s^{commit}' % branch).strip()
+
 def get_remote_name(host, prefix, name=None):
     """
     """
@@ -84,6 +133,30 @@ def get_config_filepath(conf, default):
 
     return conf
 
+def replace_block(file_path, start, end, lines):
+    """
+    Replaces the lines of file_path from the one matching start
+    to the one matching end with lines. They are passed to awk in
+    a file, as a command line can't hold the blocks of big fleets.
+    """
+    fp = tempfile.NamedTemporaryFile(suffix='.block')
+    fp.write(''.join(['%s\n' % l for l in lines]))
+    fp.flush()
+
+    new_path = file_path + '.bak'
+    try:
+        local("awk -v start='%s' -v end='%s' -v block='%s' '{\
+                if (match($0, start)) { \
+                    while ((getline line < block) > 0) print line; \
+                    close(block); \
+                    while (getline > 0) { if (match($0, end)) break; } \
+                    next; } \
+                print $0 }' %s > %s" % (start, end, fp.name, file_path,
+                                         new_path))
+    finally:
+        fp.close()
+    local('mv %s %s' % (new_path, file_path))
+
 def get_task_instance(name):
     """
     """
@@ -8,4 +8,5 @@ import firewall
 import manage
 import api
 import snmp
-import celery
\ No newline at end of file
+import celery
+import fleet
\ No newline at end of file
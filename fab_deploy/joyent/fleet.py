@@ -0,0 +1,4 @@
+from fab_deploy.base import fleet as base_fleet
+
+
+converge = base_fleet.Converge()
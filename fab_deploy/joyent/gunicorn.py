@@ -4,8 +4,17 @@ from fab_deploy.base import gunicorn as base_gunicorn
 
 from fabric.api import run, sudo, env
 from fabric.tasks import Task
+from fabric.context_managers import settings, hide
 
 class GunicornControl(base_gunicorn.Control):
+    # SMF tracks the whole contract so
+    # binary upgrades are safe
+    reload_method = 'USR2'
+
+    def _get_master_pid(self):
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = run('pgrep -o -c `svcs -Ho ctid %s`' % self.get_name())
+        return output.strip()
 
     def start(self):
         run('svcadm enable %s' % self.get_name())
@@ -32,6 +41,11 @@ class GunicornInstall(base_gunicorn.GunicornInstall):
                                                env.project_env_var,
                                                env_value))
 
+    def _setup_tuning(self, args):
+        run('svccfg -s %s setenv GUNICORN_CMD_ARGS "%s"' % (self.gunicorn_name,
+                                                           args))
+        run('svcadm refresh %s' % self.gunicorn_name)
+
     def _setup_rotate(self, path):
         sudo('logadm -C 3 -p1d -c -w %s -z 1' % path)
 
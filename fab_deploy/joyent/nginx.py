@@ -1,9 +1,15 @@
 import os
+import sys
+import hashlib
+import urlparse
+from fractions import gcd
 
 from fab_deploy.base import nginx as base_nginx
 from fab_deploy.base.setup import Control
+from fab_deploy.base import facts
+from fab_deploy import functions
 
-from fabric.api import run, sudo, env, local
+from fabric.api import run, sudo, env, local, execute
 from fabric.tasks import Task
 
 
@@ -48,6 +54,15 @@ class UpdateAppServers(Task):
     the attribute on the task and rebuilds the list of
     app servers.
 
+    When every app server has its gunicorn worker count (or
+    else its cores) recorded in your server.ini the servers
+    are weighted by it. The balancing method, least_conn or
+    hash for example, and the size of the keepalive connection
+    pool are read from the lb-method and upstream-keepalive
+    options of the section. For the pool to be used the location
+    that proxies to the app servers must set
+    ``proxy_http_version 1.1;`` and ``proxy_set_header Connection "";``.
+
     Changes made by this task are not commited to your repo, or deployed
     anywhere automatically. You should review any changes and commit and
     deploy as appropriate.
@@ -59,37 +74,73 @@ class UpdateAppServers(Task):
     START_DELM = "## Start App Servers ##"
     END_DELM = "## End App Servers ##"
     LINE = "server   %s:8000 max_fails=5  fail_timeout=60s;"
+    WEIGHTED_LINE = "server   %s:8000 weight=%s max_fails=5  fail_timeout=60s;"
+    METHOD_LINE = "%s;"
+    KEEPALIVE_LINE = "keepalive %s;"
     START = None
     END = None
 
+    method = None
+    keepalive = 32
+
     name = 'update_app_servers'
     serial = True
 
+    def _get_weights(self, section):
+        conf = env.config_object
+        connections = conf.get_list(section, conf.CONNECTIONS)
+        for option in (conf.HOST_WORKERS, conf.HOST_CORES):
+            values = conf.get_dict(section, option)
+            if connections and all([values.get(c) for c in connections]):
+                weights = [int(values[c]) for c in connections]
+                divisor = reduce(gcd, weights)
+                return [w / divisor for w in weights]
+        return None
+
+    def _get_lines(self, section):
+        conf = env.config_object
+        ips = conf.get_list(section, conf.INTERNAL_IPS)
+
+        method = self.method
+        if conf.has_option(section, conf.LB_METHOD):
+            method = conf.get(section, conf.LB_METHOD)
+
+        keepalive = self.keepalive
+        if conf.has_option(section, conf.UPSTREAM_KEEPALIVE):
+            keepalive = conf.getint(section, conf.UPSTREAM_KEEPALIVE)
+
+        lines = []
+        if method:
+            lines.append(self.METHOD_LINE % method)
+
+        weights = self._get_weights(section)
+        if weights and len(weights) == len(ips) and len(set(weights)) > 1:
+            for ip, weight in zip(ips, weights):
+                lines.append(self.WEIGHTED_LINE % (ip, weight))
+        else:
+            for ip in ips:
+                lines.append(self.LINE % ip)
+
+        if keepalive:
+            lines.append(self.KEEPALIVE_LINE % keepalive)
+        return lines
+
+    def _write_block(self, file_path, start, end, text):
+        functions.replace_block(file_path, start, end, text)
+
     def _update_file(self, nginx_conf, section):
         file_path = os.path.join(env.deploy_path, nginx_conf)
         text = [self.START_DELM]
         if self.START:
             text.append(self.START)
 
-        for ip in env.config_object.get_list(section, env.config_object.INTERNAL_IPS):
-            text.append(self.LINE % ip)
+        text.extend(self._get_lines(section))
 
         if self.END:
             text.append(self.END)
         text.append(self.END_DELM)
 
-        txt = "\\n".join(text)
-        new_path = file_path + '.bak'
-        cmd = "awk '{\
-                tmp = match($0, \"%s\"); \
-                if (tmp) { \
-                    print \"%s\"; \
-                    while(getline>0){tmp2 = match($0, \"%s\"); if (tmp2) break;} \
-                    next;} \
-                {print $0}}' %s > %s" %(self.START_DELM, txt, self.END_DELM,
-                                        file_path, new_path)
-        local(cmd)
-        local('mv %s %s' %(new_path, file_path))
+        self._write_block(file_path, self.START_DELM, self.END_DELM, text)
 
     def run(self, section=None, nginx_conf=None):
         assert section and nginx_conf
@@ -118,7 +169,209 @@ class UpdateAllowedIPs(UpdateAppServers):
 
     name = 'update_allowed_ips'
 
+    def _get_lines(self, section):
+        return [self.LINE % ip for ip in env.config_object.get_list(section,
+                                            env.config_object.INTERNAL_IPS)]
+
+class UpdateProxyCache(UpdateAppServers):
+    """
+    Build the proxy cache settings in your load balancer nginx config.
+
+    Rebuilds two blocks. The one between ``## Start Proxy Cache ##``
+    and ``## End Proxy Cache ##`` belongs in the http context and
+    declares the cache zone, the cache key and which requests bypass
+    the cache. The one between ``## Start Cache Locations ##`` and
+    ``## End Cache Locations ##`` belongs in the server that proxies
+    to the app servers and turns on micro-caching with cache locking
+    and stale responses while the cache updates in the background.
+    Keep your proxy_set_header lines at the server level so the
+    generated locations inherit them.
+
+    The keys zone is sized from the memory of the smallest load
+    balancer, probing it if it isn't recorded in the section yet.
+    These options of the section are used:
+
+    * **cache-zone-size**: The keys zone size, overrides the probe.
+    * **cache-max-size**: The maximum size of the cache on disk.
+    * **cache-ttl**: How long responses are cached by default.
+    * **cache-locations**: Locations with their own ttl as
+                         location=ttl pairs, /about/=10m for example.
+    * **cache-bypass-cookies**: Requests with any of these cookies, the
+                              session cookie for example, are not cached.
+    * **cache-upstream**: The name of the app servers upstream.
+
+    Changes made by this task are not commited to your repo, or deployed
+    anywhere automatically. You should review any changes and commit and
+    deploy as appropriate.
+
+    This is a serial task, that should not be called directly
+    with any remote hosts, the load balancers it probes are
+    determined by the section.
+    """
+
+    name = 'update_proxy_cache'
+
+    START_DELM = "## Start Proxy Cache ##"
+    END_DELM = "## End Proxy Cache ##"
+    LOCATIONS_START_DELM = "## Start Cache Locations ##"
+    LOCATIONS_END_DELM = "## End Cache Locations ##"
+
+    KEY = '$scheme$host$request_uri'
+    zone_name = 'microcache'
+    # Part of the memory of the load balancer given to the keys zone
+    zone_memory_ratio = 64
+    min_zone_size = 8
+    max_zone_size = 512
+    max_size = '1g'
+    ttl = '1s'
+    bypass_cookies = ['sessionid']
+    upstream = 'app_servers'
+    stale = 'updating error timeout http_500 http_502 http_503 http_504'
+
+    def _get_memory(self, section):
+        conf = env.config_object
+        connections = conf.get_list(section, conf.CONNECTIONS)
+        memory = conf.get_dict(section, conf.HOST_MEMORY)
+
+        missing = [c for c in connections if not c in memory]
+        if missing:
+            results = facts.gather_facts(missing)
+            for host, host_facts in results.items():
+                if host_facts.get('memory'):
+                    memory[host] = host_facts['memory']
+            conf.set_dict(section, conf.HOST_MEMORY, memory)
+            conf.save(env.conf_filename)
+
+        values = [int(memory[c]) for c in connections if c in memory]
+        if values:
+            return min(values)
+        return None
+
+    def _get_option(self, section, option, default):
+        if env.config_object.has_option(section, option):
+            return env.config_object.get(section, option)
+        return default
+
+    def _get_zone_size(self, section):
+        conf = env.config_object
+        if conf.has_option(section, conf.CACHE_ZONE_SIZE):
+            return conf.get(section, conf.CACHE_ZONE_SIZE)
+
+        size = self.min_zone_size
+        memory = self._get_memory(section)
+        if memory:
+            size = min(max(memory / self.zone_memory_ratio,
+                           self.min_zone_size), self.max_zone_size)
+        return '%sm' % size
+
+    def _get_cache_lines(self, section):
+        conf = env.config_object
+        cookies = conf.get_list(section, conf.CACHE_BYPASS_COOKIES)
+        if not cookies:
+            cookies = self.bypass_cookies
+
+        lines = [
+            'proxy_cache_path %s levels=1:2 keys_zone=%s:%s max_size=%s '
+                'inactive=10m;' % (base_nginx.CACHE_DIR, self.zone_name,
+                self._get_zone_size(section),
+                self._get_option(section, conf.CACHE_MAX_SIZE, self.max_size)),
+            'proxy_temp_path %s;' % base_nginx.CACHE_TMP_DIR,
+            'proxy_cache_key %s;' % self.KEY,
+            'map $http_cookie $cache_bypass {',
+            '    default 0;',
+        ]
+        for cookie in cookies:
+            lines.append('    ~%s 1;' % cookie)
+        lines.append('}')
+        return lines
+
+    def _get_location_lines(self, section):
+        conf = env.config_object
+        lines = [
+            'proxy_cache %s;' % self.zone_name,
+            'proxy_cache_valid 200 301 302 %s;' % self._get_option(section,
+                                                    conf.CACHE_TTL, self.ttl),
+            'proxy_cache_lock on;',
+            'proxy_cache_lock_timeout 5s;',
+            'proxy_cache_use_stale %s;' % self.stale,
+            'proxy_cache_background_update on;',
+            'proxy_cache_bypass $cache_bypass;',
+            'proxy_no_cache $cache_bypass;',
+            'add_header X-Cache-Status $upstream_cache_status;',
+        ]
+
+        upstream = self._get_option(section, conf.CACHE_UPSTREAM, self.upstream)
+        locations = conf.get_dict(section, conf.CACHE_LOCATIONS)
+        for location in sorted(locations):
+            lines.extend([
+                'location %s {' % location,
+                '    proxy_cache_valid 200 301 302 %s;' % locations[location],
+                '    proxy_pass http://%s;' % upstream,
+                '}',
+            ])
+        return lines
+
+    def _update_file(self, nginx_conf, section):
+        file_path = os.path.join(env.deploy_path, nginx_conf)
+
+        text = [self.START_DELM]
+        text.extend(self._get_cache_lines(section))
+        text.append(self.END_DELM)
+        self._write_block(file_path, self.START_DELM, self.END_DELM, text)
+
+        text = [self.LOCATIONS_START_DELM]
+        text.extend(self._get_location_lines(section))
+        text.append(self.LOCATIONS_END_DELM)
+        self._write_block(file_path, self.LOCATIONS_START_DELM,
+                          self.LOCATIONS_END_DELM, text)
+
+class PurgeCache(Task):
+    """
+    Purge pages from the proxy cache of a load balancer.
+
+    Takes one argument:
+
+    * **urls**: The full urls of the pages to purge separated by
+              semicolons, or all to empty the whole cache.
+
+    The cached files are found from the cache key written by
+    ``nginx.update_proxy_cache`` so no nginx purge module is needed.
+    """
+
+    name = 'purge_cache'
+
+    def _get_cache_file(self, url):
+        parts = urlparse.urlsplit(url)
+        uri = parts.path or '/'
+        if parts.query:
+            uri = '%s?%s' % (uri, parts.query)
+
+        key = UpdateProxyCache.KEY.replace('$scheme', parts.scheme) \
+                                  .replace('$host', parts.netloc) \
+                                  .replace('$request_uri', uri)
+        digest = hashlib.md5(key).hexdigest()
+        # levels=1:2
+        return os.path.join(base_nginx.CACHE_DIR, digest[-1], digest[-3:-1],
+                            digest)
+
+    def run(self, urls=None, hosts=[]):
+        if not urls:
+            print "You must provide the urls to purge or all"
+            sys.exit(1)
+
+        if urls == 'all':
+            sudo('find %s -type f -exec rm -f {} +' % base_nginx.CACHE_DIR)
+            return
+
+        paths = [self._get_cache_file(x.strip()) for x in urls.split(';')
+                 if x.strip()]
+        if paths:
+            sudo('rm -f %s' % ' '.join(paths))
+
 update_app_servers = UpdateAppServers()
+update_proxy_cache = UpdateProxyCache()
+purge_cache = PurgeCache()
 update_allowed_ips = UpdateAllowedIPs()
+latency = base_nginx.LatencyStats()
 setup = NginxInstall()
 control = NginxControl()
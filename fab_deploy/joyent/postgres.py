@@ -59,6 +59,13 @@ class SlaveSetup(JoyentMixin, base_postgres.SlaveSetup):
 
     name = 'slave_setup'
 
+class MultiSlaveSetup(JoyentMixin, base_postgres.MultiSlaveSetup):
+    """
+    Set up several slaves with streaming replication at once
+    """
+
+    name = 'multi_slave_setup'
+
 class PGBouncerInstall(Task):
     """
     Set up PGBouncer on a database server
@@ -164,4 +171,5 @@ class PGBouncerInstall(Task):
 
 setup = PostgresInstall()
 slave_setup = SlaveSetup()
+multi_slave_setup = MultiSlaveSetup()
 setup_pgbouncer = PGBouncerInstall()
@@ -13,13 +13,23 @@ class JoyentMixin(object):
     def _ssh_restart(self):
         run('svcadm restart ssh')
 
+    def _installed_packages_command(self, packages):
+        return ('for p in %s; do pkg_info -qe $p >/dev/null && echo $p; done'
+                % ' '.join(packages))
+
+    def _install_packages_command(self, packages):
+        command = 'pkg_add %s' % ' '.join(packages)
+        proxy = self._get_package_proxy()
+        if proxy:
+            command = 'PKG_PATH=%s %s' % (proxy, command)
+        return command
+
 class AppMixin(JoyentMixin):
     packages = ['python27', 'py27-psycopg2', 'py27-setuptools',
                 'py27-imaging', 'py27-expat']
 
     def _install_packages(self):
-        for package in self.packages:
-            sudo('pkg_add %s' % package)
+        self._install_package_list(self.packages)
         sudo('easy_install-2.7 pip')
         self._install_venv()
 
@@ -1,10 +1,15 @@
 import random
 from fabric.api import task, run
 
+from fab_deploy.base import facts
+
 @task
 def get_ip(interface, hosts=[]):
     """
     """
+    if not interface:
+        return facts.get_fact('ip')
+
     return run(get_ip_command(interface))
 
 def get_ip_command(interface):
@@ -15,3 +20,7 @@ def get_ip_command(interface):
     return 'ifconfig %s | grep inet | grep -v inet6 | cut -d ":" -f 2 | cut -d " " -f 2' % interface
 
 
+class JoyentFacts(facts.GatherFacts):
+    ip_command = get_ip_command(None)
+
+get_facts = JoyentFacts()
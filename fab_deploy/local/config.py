@@ -1,13 +1,18 @@
-from fabric.api import local, env, execute
+from fabric.api import local, env, execute, settings
 from fabric.tasks import Task
 
 from fab_deploy.functions import get_answer, get_remote_name
+from fab_deploy.base import facts
 
 class InternalIps(Task):
     """
     Updates your server.ini config with the correct
     internal ip addresses for all hosts
 
+    The hosts of every section are probed together in parallel,
+    at most pool_size at a time (or the value of fab's -z option),
+    and the config is written once after all of them answered.
+
     This is a serial task, that should not be called
     with any remote hosts as the remote hosts to run
     on is determined by the hosts in your server.ini
@@ -16,9 +21,12 @@ class InternalIps(Task):
 
     name = 'update_internal_ips'
     serial = True
+    pool_size = 20
 
     def run(self):
         conf = env.config_object
+        sections = []
+        hosts = []
         for section in conf.server_sections():
             internals = conf.get_list(section, conf.INTERNAL_IPS)
             connections = conf.get_list(section, conf.CONNECTIONS)
@@ -26,12 +34,24 @@ class InternalIps(Task):
                 raise Exception("Number of connections and internal ips do not match")
 
             if internals:
-                results = execute('utils.get_ip', None, hosts=connections)
-                for i, conn in enumerate(connections):
-                    internals[i] = results[conn]
+                sections.append((section, connections))
+                hosts.extend([c for c in connections if not c in hosts])
+
+        if not hosts:
+            return
+
+        with settings(pool_size=env.pool_size or self.pool_size):
+            results = facts.gather_facts(hosts, refresh=True)
+
+        missing = [h for h in hosts if not results[h].get('ip')]
+        if missing:
+            raise Exception("Couldn't get the internal ip of %s"
+                            % ', '.join(missing))
 
-                conf.set_list(section, conf.INTERNAL_IPS, internals)
-                conf.save(env.conf_filename)
+        for section, connections in sections:
+            internals = [results[c]['ip'] for c in connections]
+            conf.set_list(section, conf.INTERNAL_IPS, internals)
+        conf.save(env.conf_filename)
 
 class SyncGit(Task):
     """
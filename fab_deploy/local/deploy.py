@@ -1,103 +1,1009 @@
 import os
-from fabric.api import local, env, execute
+import sys
+import gzip
+import hashlib
+import json
+import multiprocessing
+import tarfile
+import tempfile
+import time
+from cStringIO import StringIO
+
+from fabric.api import local, env, execute, run, sudo, put
 from fabric.tasks import Task
-from fabric.context_managers import settings, hide
+from fabric.context_managers import settings, hide, cd, lcd
+from fabric.contrib.files import exists
+
+from fab_deploy import functions
+from fab_deploy.base import facts
+from fab_deploy.base.git import INSTALL_REQUIREMENTS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MANIFEST = '.compressed.json'
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.html', '.htm', '.svg', '.txt',
+                           '.xml', '.json', '.map', '.ico', '.eot', '.ttf',
+                           '.otf')
+
+# Hard links the files under a cache_prefix path of argv[1] into
+# argv[2] and copies the symlinks, run with the python of a host
+CARRY_OVER_SCRIPT = """import os, sys
+src, dst, prefix = sys.argv[1:4]
+for root, dirs, files in os.walk(src):
+    rel = os.path.relpath(root, src)
+    inside = [p for p in rel.split(os.sep) if p.startswith(prefix)]
+    for name in dirs + files:
+        path = os.path.join(root, name)
+        target = os.path.normpath(os.path.join(dst, rel, name))
+        if not (inside or name.startswith(prefix)) or os.path.lexists(target):
+            continue
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        if os.path.islink(path):
+            os.symlink(os.readlink(path), target)
+        elif os.path.isdir(path):
+            os.makedirs(target)
+        elif os.path.isfile(path):
+            os.link(path, target)
+"""
+
+def _gzip(data):
+    buf = StringIO()
+    # A fixed mtime keeps the output the same for the same input
+    fp = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    fp.write(data)
+    fp.close()
+    return buf.getvalue()
+
+def compress_file(args):
+    """
+    Writes the .gz (and .br) variants next to the file at path.
+    A variant that isn't smaller than the original is removed
+    instead so nginx serves the original.
+    """
+    path, with_brotli = args
+
+    fp = open(path, 'rb')
+    data = fp.read()
+    fp.close()
+
+    variants = [('.gz', _gzip)]
+    if with_brotli:
+        variants.append(('.br', brotli.compress))
+
+    for ext, compress in variants:
+        compressed = compress(data)
+        variant = path + ext
+        if len(compressed) < len(data):
+            fp = open(variant, 'wb')
+            fp.write(compressed)
+            fp.close()
+        elif os.path.exists(variant):
+            os.remove(variant)
+
+def get_static_hash(static_dir):
+    """
+    Returns a hash of the names and contents of the files in
+    static_dir, or '' if it doesn't exist. Contents rather than
+    modification times, so a prep that rewrites the same files
+    or a fresh worktree gives the same hash.
+    """
+    if not os.path.exists(static_dir):
+        return ''
+
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(static_dir):
+        dirs.sort()
+        for name in sorted(files):
+            # The manifest isn't synced to the hosts
+            if name == COMPRESS_MANIFEST:
+                continue
+            path = os.path.join(root, name)
+            file_digest = hashlib.sha1()
+            fp = open(path, 'rb')
+            for chunk in iter(lambda: fp.read(65536), ''):
+                file_digest.update(chunk)
+            fp.close()
+            digest.update('%s %s\n' % (os.path.relpath(path, static_dir),
+                                       file_digest.hexdigest()))
+    return digest.hexdigest()
 
 class Deploy(Task):
     """
     Deploys your project.
 
-    Takes one optional argument:
+    Takes the following optional arguments:
         branch: The branch that you would like to push.
                 If it is not provided 'master' will be used.
 
+        reload: Gracefully reload gunicorn after the push
+                using 'gunicorn.control:reload=True'.
+                If warmup_urls is set the host is then warmed
+                up before the deploy moves on, see below.
+
 
     This rsync's your collected-static directory with the remote
     then executes 'local.git.push'.
+
+    With install_requirements set, the requirements are then installed
+    on hosts that have a virtualenv using the install-requirements
+    hook, which skips the install when the requirements hash recorded
+    on the host matches the branch. Set wheelhouse to a local directory
+    to keep a shared wheel cache: missing wheels are built on
+    wheel_host, collected in the wheelhouse and synced to each host,
+    and packages are then only installed from it. wheel_host must be
+    set with it, as wheels built on your machine may not work on the
+    servers.
+
+    With use_releases set every commit is deployed to its own
+    directory in releases_dir, and env.git_working_dir becomes a
+    symlink to the active one. The code is exported from the remote
+    repo, the virtualenv copied from the active release and the
+    static files synced hard linking the unchanged ones. The files
+    starting with cache_prefix that were made on the host are hard
+    linked from the active release too. Then the
+    requirements are installed, the code is compiled to bytecode
+    using all cores and the smoke_imports modules are imported from
+    project with the release's python. Only if that works the symlink
+    is switched, so gunicorn never sees a half updated tree. Your
+    post-receive hook must not check out the code into the working
+    dir when using releases, and gunicorn should be started with
+    ``--chdir`` set to the working dir so reloads follow the link.
+
+    Warming up requests every path in warmup_urls from gunicorn over
+    the host's internal ip, warmup_concurrency times each and that
+    many at once. This is repeated until every request of a round
+    answers with a 2xx or 3xx status and the slowest takes less than
+    warmup_threshold seconds, so workers have loaded their templates,
+    urls and connections before users reach them. Set warmup_host to
+    a name in your ALLOWED_HOSTS to send it as the Host header. The
+    time it took is printed and added to the deploy timings.
+
+    After a host is deployed the commit and a hash of the static
+    files are written to deployed_file in the working dir, which
+    ``deploy`` uses to skip hosts that are up to date.
+
+    The newest keep_releases releases are kept for ``rollback``, as
+    long as they fit in releases_budget MB when that is set. Older
+    ones are removed after each deploy, but never the active one.
+
+    With use_artifacts also set, ``local.deploy.prep`` packs the code,
+    the collected static and the wheelhouse into one compressed
+    artifact named after the sha1 of its content. Each host gets the
+    artifact with a resumable rsync, unless it has it already, and it
+    is unpacked into the release instead of pushing and syncing.
+    Requirements are installed from the artifact's wheelhouse. The
+    virtualenv itself is not part of it, as it isn't portable between
+    your machine and the servers.
     """
 
     cache_prefix = 'c-'
     name = 'do'
 
-    def _sync_files(self, branch):
+    install_requirements = False
+    wheelhouse = None
+    wheel_host = None
+    remote_wheelhouse = 'wheelhouse'
+
+    deployed_file = '.deployed'
+
+    use_releases = False
+    releases_dir = '/srv/releases'
+    # Created once the release is complete
+    release_marker = '.release-ready'
+    smoke_imports = ('settings',)
+    keep_releases = 5
+    releases_budget = None
+
+    # Paths requested from each host after it is reloaded
+    warmup_urls = ()
+    warmup_url = 'http://%(ip)s:8000%(path)s'
+    # Sent as the Host header, so it passes ALLOWED_HOSTS
+    warmup_host = None
+    warmup_concurrency = 4
+    # Seconds the slowest request has to be faster than
+    warmup_threshold = 0.5
+    warmup_rounds = 10
+
+    use_artifacts = False
+    artifacts_dir = None
+    # Where artifacts are kept on the hosts, in releases_dir
+    remote_artifacts = '.artifacts'
+
+    def _sync_static(self, branch, working_dir, link_dest=None):
+        """
+        Sync collected static from the worktree branch was prepped
+        in, make sure remote links with the self.cache_prefix
+        aren't deleted.
         """
-        Sync collected static, make sure remote links with
-        the self.cache_prefix aren't deleted.
+        prep = functions.get_task_instance('local.deploy.prep')
+        build_dir = prep.get_build_dir(branch)
+
+        link = ''
+        if link_dest:
+            link = ' --link-dest=%s' % link_dest
+        local('rsync -rptv --progress --delete-after%s --filter "P %s*" --filter "- %s" %s/collected-static/ %s:%s/collected-static' % (link, self.cache_prefix, COMPRESS_MANIFEST, build_dir, env.host_string, working_dir))
+
+    def _presync_static(self, branch):
+        """
+        Syncs the static files ahead of pushing to many hosts
+        at once, so no host gets the code before them.
         """
+        self._sync_static(branch, env.git_working_dir)
+        return True
 
-        local('rsync -rptv --progress --delete-after --filter "P %s*" %s/collected-static/ %s:%s/collected-static' % (self.cache_prefix, env.project_path, env.host_string, env.git_working_dir))
+    def _sync_files(self, branch):
+        if not env.host_string in env.get('static_synced', []):
+            self._sync_static(branch, env.git_working_dir)
         execute('local.git.push', branch=branch, hosts=[env.host_string])
 
+    def _get_release_dir(self, commit):
+        return os.path.join(self.releases_dir, commit)
+
+    def _make_releases_dir(self):
+        with settings(hide('warnings'), warn_only=True):
+            result = run('mkdir -p %s' % self.releases_dir)
+        if result.failed:
+            user = run('whoami')
+            sudo('mkdir -p %s' % self.releases_dir)
+            sudo('chown %s %s' % (user, self.releases_dir))
+
+    def _copy_env(self, release):
+        active_env = os.path.join(env.git_working_dir, 'env')
+        run('if [ -d %s ]; then (cd %s && tar -cf - env) | '
+            '(cd %s && tar -xpf -); fi' % (active_env, env.git_working_dir,
+                                          release))
+
+    def _create_release(self, commit):
+        """
+        Exports commit from the remote repo to its release directory
+        with a copy of the active virtualenv, unless that was done
+        before. Returns the directory.
+        """
+        release = self._get_release_dir(commit)
+        if exists(os.path.join(release, self.release_marker)):
+            return release
+
+        self._make_releases_dir()
+        run('rm -rf %s && mkdir %s' % (release, release))
+        with cd(env.git_repo_name):
+            run('git archive %s | tar -xf - -C %s' % (commit, release))
+        self._copy_env(release)
+        return release
+
+    def _get_artifacts_dir(self):
+        return self.artifacts_dir or os.path.join(os.path.expanduser('~'),
+                                '.fab_deploy', 'artifacts', env.project_name)
+
+    def _get_artifact_key(self, branch):
+        """
+        Returns a hash of everything that goes into the artifact
+        of branch, without reading the files.
+        """
+        key = [self.get_revision(branch)]
+        if self.wheelhouse:
+            wheelhouse = os.path.expanduser(self.wheelhouse)
+            if os.path.exists(wheelhouse):
+                key.extend(sorted(os.listdir(wheelhouse)))
+        return hashlib.sha1('\n'.join(key)).hexdigest()
+
+    def _load_artifacts_index(self):
+        path = os.path.join(self._get_artifacts_dir(), 'index.json')
+        if not os.path.exists(path):
+            return {}
+        fp = open(path)
+        index = json.load(fp)
+        fp.close()
+        return index
+
+    def get_artifact(self, branch='master'):
+        """
+        Returns the path of the artifact built for branch as
+        it is prepped now, None if there isn't one.
+        """
+        name = self._load_artifacts_index().get(self._get_artifact_key(branch))
+        if name:
+            path = os.path.join(self._get_artifacts_dir(), name)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def build_artifact(self, branch='master'):
+        """
+        Packs the code of branch, the static files it was prepped
+        with and the wheelhouse into a compressed tar named after
+        the sha1 of its content. Returns its path.
+        """
+        path = self.get_artifact(branch)
+        if path:
+            # Reusing it counts as using it when pruning
+            os.utime(path, None)
+            return path
+
+        if self.wheelhouse and self.install_requirements:
+            self._build_wheels(branch, functions.get_requirements_hash(branch))
+
+        artifacts_dir = self._get_artifacts_dir()
+        if not os.path.exists(artifacts_dir):
+            os.makedirs(artifacts_dir)
+
+        prep = functions.get_task_instance('local.deploy.prep')
+        static_dir = os.path.join(prep.get_build_dir(branch),
+                                  'collected-static')
+        fd, tar_name = tempfile.mkstemp(dir=artifacts_dir)
+        os.close(fd)
+        with lcd(env.project_path):
+            local('git archive --format=tar -o %s %s' % (
+                    tar_name, functions.get_commit(branch)))
+
+        fp = tarfile.open(tar_name, 'a')
+        if os.path.exists(static_dir):
+            fp.add(static_dir, arcname='collected-static',
+                   filter=lambda info: not info.name.endswith(
+                                        COMPRESS_MANIFEST) and info or None)
+        if self.wheelhouse:
+            wheelhouse = os.path.expanduser(self.wheelhouse)
+            if os.path.exists(wheelhouse):
+                fp.add(wheelhouse, arcname='wheelhouse')
+        fp.close()
+
+        digest = hashlib.sha1()
+        gz_name = tar_name + '.gz'
+        source = open(tar_name, 'rb')
+        out = open(gz_name, 'wb')
+        gz = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+        while True:
+            data = source.read(1024 * 1024)
+            if not data:
+                break
+            gz.write(data)
+        gz.close()
+        out.close()
+        source.close()
+        os.remove(tar_name)
+
+        fp = open(gz_name, 'rb')
+        for data in iter(lambda: fp.read(1024 * 1024), ''):
+            digest.update(data)
+        fp.close()
+
+        name = '%s.tar.gz' % digest.hexdigest()
+        path = os.path.join(artifacts_dir, name)
+        os.rename(gz_name, path)
+
+        # Keep the most recently used artifacts, as many as the hosts
+        # keep releases but at least this one and the one before it
+        keep = max(self.keep_releases, 2)
+        index = self._load_artifacts_index()
+        index[self._get_artifact_key(branch)] = name
+        names = [n for n in os.listdir(artifacts_dir) if n.endswith('.tar.gz')]
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(artifacts_dir,
+                                                               n)))
+        for old in names[:-keep]:
+            if old != name:
+                os.remove(os.path.join(artifacts_dir, old))
+        kept = names[-keep:] + [name]
+        index = dict([(k, v) for k, v in index.items() if v in kept])
+        fp = open(os.path.join(artifacts_dir, 'index.json'), 'w')
+        json.dump(index, fp, indent=1)
+        fp.close()
+
+        print "Built %s (%s KB)" % (name, os.path.getsize(path) / 1024)
+        return path
+
+    def _get_remote_artifact(self, artifact):
+        return os.path.join(self.releases_dir, self.remote_artifacts,
+                            os.path.basename(artifact))
+
+    def _ship_artifact(self, artifact):
+        """
+        Copies artifact to env.host_string unless it is there
+        already. An interrupted copy is resumed the next time.
+        Returns the path on the host.
+        """
+        remote_path = self._get_remote_artifact(artifact)
+        if exists(remote_path):
+            # Keeps it from being cleaned up as an old one
+            run('touch %s' % remote_path)
+            return remote_path
+
+        self._make_releases_dir()
+        run('mkdir -p %s' % os.path.dirname(remote_path))
+        local('rsync -t --partial --append-verify %s %s:%s.part' % (
+                artifact, env.host_string, remote_path))
+        run('mv %s.part %s' % (remote_path, remote_path))
+        return remote_path
+
+    def _unpack_artifact(self, commit, remote_path):
+        """
+        Unpacks the artifact at remote_path into the release
+        directory of commit with a copy of the active virtualenv.
+        Returns the directory.
+        """
+        release = self._get_release_dir(commit)
+        if exists(os.path.join(release, self.release_marker)):
+            return release
+
+        run('rm -rf %s && mkdir %s' % (release, release))
+        run('gzip -dc %s | tar -xf - -C %s' % (remote_path, release))
+        self._copy_env(release)
+        return release
+
+    def _install_from_release(self, branch, release):
+        """
+        Installs the requirements into the virtualenv of release
+        from the wheelhouse in the release, or from PyPI if the
+        artifact doesn't have one.
+        """
+        python = os.path.join(release, 'env', 'bin', 'python')
+        if not exists(python):
+            return
+
+        req_hash = functions.get_requirements_hash(branch)
+        if functions.get_installed_requirements_hash(release) == req_hash:
+            print "Requirements unchanged, skipping install"
+            return
+
+        wheelhouse = os.path.join(release, 'wheelhouse')
+        find_links = ''
+        if exists(wheelhouse):
+            find_links = '--no-index --find-links %s ' % wheelhouse
+        run('%s -m pip install %s-r %s' % (python, find_links,
+                                os.path.join(release, 'requirements.txt')))
+        run('echo %s > %s' % (req_hash, os.path.join(release,
+                                        functions.REQUIREMENTS_HASH_FILE)))
+
+    def _compile_release(self, release):
+        """
+        Compiles the code of release to bytecode with a process
+        per core, so workers don't have to when they start.
+        """
+        python = os.path.join(release, 'env', 'bin', 'python')
+        if not exists(python):
+            python = 'python'
+        cores = facts.get_fact('cores', default=1)
+        # Files that don't compile are left to the smoke test
+        with settings(warn_only=True):
+            run("find %s -name '*.py' ! -path '%s/env/*' | "
+                "xargs -n 100 -P %s %s -m py_compile" % (release, release,
+                                                        cores, python))
+
+    def _smoke_test(self, release):
+        python = os.path.join(release, 'env', 'bin', 'python')
+        if not self.smoke_imports or not exists(python):
+            return
+
+        project = os.path.join(release, 'project')
+        with settings(warn_only=True):
+            result = run('cd %s && PYTHONPATH=%s:%s %s -c "import %s"' % (
+                            project, release, project, python,
+                            ', '.join(self.smoke_imports)))
+        if result.failed:
+            print "The release %s failed to import, keeping the active one" % (
+                                                                    release)
+            sys.exit(1)
+
+    def _activate_release(self, release):
+        """
+        Points env.git_working_dir at release by renaming a new
+        symlink over it. A working dir from before releases were
+        used is moved into releases_dir first.
+        """
+        link = env.git_working_dir
+        previous = os.path.join(self.releases_dir, 'previous')
+        sudo("python -c 'import os; "
+             "os.path.lexists(\"%(link)s.new\") and os.remove(\"%(link)s.new\"); "
+             "os.path.islink(\"%(link)s\") or not os.path.isdir(\"%(link)s\") "
+             "or os.rename(\"%(link)s\", \"%(previous)s\"); "
+             "os.symlink(\"%(release)s\", \"%(link)s.new\"); "
+             "os.rename(\"%(link)s.new\", \"%(link)s\")'"
+             % {'link': link, 'previous': previous, 'release': release})
+
+    def _get_releases(self):
+        """
+        Returns the names of the complete releases,
+        the most recently deployed first.
+        """
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = run('cd %s && ls -t */%s' % (self.releases_dir,
+                                                  self.release_marker))
+        if output.failed:
+            return []
+        return [line.split('/')[0] for line in output.split()]
+
+    def _get_active_release(self):
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = run('readlink %s' % env.git_working_dir)
+        if output.failed:
+            return None
+        return os.path.basename(output.strip().rstrip('/'))
+
+    def _get_sizes(self, releases):
+        """
+        Returns the KB each release adds. du counts files hard
+        linked between releases only for the first one listed.
+        """
+        with settings(hide('running', 'output')):
+            output = run('cd %s && du -sk %s' % (self.releases_dir,
+                                                 ' '.join(releases)))
+        sizes = {}
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0].isdigit():
+                sizes[parts[1].rstrip('/')] = int(parts[0])
+        return sizes
+
+    def _clean_releases(self):
+        """
+        Removes the releases beyond keep_releases or
+        releases_budget, keeping the newest and the active one.
+        """
+        releases = self._get_releases()
+        if len(releases) <= 1:
+            return
+
+        active = self._get_active_release()
+        sizes = {}
+        if self.releases_budget:
+            sizes = self._get_sizes(releases)
+
+        keep = []
+        total = 0
+        for name in releases:
+            total += sizes.get(name, 0)
+            fits = (len(keep) < self.keep_releases and
+                    (not self.releases_budget or
+                     total <= int(self.releases_budget) * 1024))
+            if name == active or not keep or fits:
+                keep.append(name)
+
+        remove = [r for r in releases if not r in keep]
+        if remove:
+            with cd(self.releases_dir):
+                run('rm -rf %s' % ' '.join(remove))
+
+        if self.use_artifacts:
+            with settings(warn_only=True):
+                run("cd %s && ls -t *.tar.gz | sed -e '1,%sd' | xargs rm -f"
+                    % (os.path.join(self.releases_dir, self.remote_artifacts),
+                       max(len(keep), 2)))
+
+    def _rollback(self, release=None):
+        """
+        Switches env.host_string to release, or the release deployed
+        before the active one, and reloads gunicorn gracefully.
+        Returns the name of the release.
+        """
+        releases = self._get_releases()
+        active = self._get_active_release()
+
+        if release:
+            matches = [r for r in releases if r.startswith(release)]
+            if len(matches) != 1:
+                print "%s has %s releases matching %s" % (env.host_string,
+                                                  len(matches), release)
+                sys.exit(1)
+            target = matches[0]
+        else:
+            older = releases
+            if active in releases:
+                older = releases[releases.index(active) + 1:]
+            if not older:
+                print "%s has no release to roll back to" % env.host_string
+                sys.exit(1)
+            target = older[0]
+
+        if target != active:
+            self._activate_release(self._get_release_dir(target))
+            if functions.get_task_instance('gunicorn.control'):
+                self._update_service()
+                self._reload()
+        return target
+
+    def _carry_over_cache(self, release):
+        """
+        Links the files with the cache_prefix the host made in
+        the active collected static into the one of release, as
+        syncing only brings the files of the build.
+        """
+        active = os.path.join(env.git_working_dir, 'collected-static')
+        run("if [ -d %s ]; then python -c '%s' %s %s %s; fi" % (active,
+                    CARRY_OVER_SCRIPT, active,
+                    os.path.join(release, 'collected-static'),
+                    self.cache_prefix))
+
+    def _deploy_release(self, branch):
+        """
+        Builds the release of branch next to the active one
+        and switches to it once it passes the smoke test.
+        """
+        commit = functions.get_commit(branch)
+        if self.use_artifacts:
+            artifact = self.get_artifact(branch)
+            if not artifact:
+                print "There is no artifact for %s, run local.deploy.prep" % (
+                                                                    branch)
+                sys.exit(1)
+            release = self._unpack_artifact(commit,
+                                            self._ship_artifact(artifact))
+            self._carry_over_cache(release)
+            if self.install_requirements:
+                self._install_from_release(branch, release)
+        else:
+            execute('local.git.push', branch=branch,
+                    hosts=[env.host_string])
+            release = self._create_release(commit)
+            self._carry_over_cache(release)
+            self._sync_static(branch, release,
+                          os.path.join(env.git_working_dir, 'collected-static'))
+            if self.install_requirements:
+                self._install_requirements(branch, release)
+        self._compile_release(release)
+        self._smoke_test(release)
+        run('touch %s' % os.path.join(release, self.release_marker))
+        self._activate_release(release)
+        self._clean_releases()
+
     def _post_sync(self):
         """
         Hook that is executed after a git push.
         """
         pass
 
-    def run(self, branch=None):
+    def _build_wheels(self, branch, req_hash):
+        """
+        Builds wheels for the branch's requirements on wheel_host
+        and adds them to the local wheelhouse. Only done once
+        per requirements hash.
+        """
+        if env.get('wheels_built') == req_hash:
+            return
+
+        if not self.wheel_host:
+            print ("wheelhouse is set but wheel_host isn't, set it to a "
+                   "host like your servers to build the wheels on")
+            sys.exit(1)
+
+        wheelhouse = os.path.expanduser(self.wheelhouse)
+        local('mkdir -p %s' % wheelhouse)
+
+        requirements = functions.call_command('git', 'show',
+                                        '%s:requirements.txt' % branch)
+        fp = tempfile.NamedTemporaryFile(suffix='.txt')
+        fp.write(requirements)
+        fp.flush()
+
+        remote_req = '/tmp/requirements-%s.txt' % req_hash
+        try:
+            with settings(host_string=self.wheel_host):
+                put(fp.name, remote_req)
+                run('%s/env/bin/pip wheel --find-links %s -w %s -r %s' % (
+                        env.git_working_dir, self.remote_wheelhouse,
+                        self.remote_wheelhouse, remote_req))
+        finally:
+            fp.close()
+        local('rsync -rt %s:%s/ %s/' % (self.wheel_host,
+                                self.remote_wheelhouse, wheelhouse))
+        env.wheels_built = req_hash
+
+    def _install_requirements(self, branch, working_dir=None):
+        if not working_dir:
+            working_dir = env.git_working_dir
+        if not exists(os.path.join(working_dir, 'env', 'bin', 'pip')):
+            return
+
+        req_hash = functions.get_requirements_hash(branch)
+        if functions.get_installed_requirements_hash(working_dir) == req_hash:
+            print "Requirements unchanged, skipping install"
+            return
+
+        find_links = ''
+        if self.wheelhouse:
+            self._build_wheels(branch, req_hash)
+            local('rsync -rt %s/ %s:%s/' % (os.path.expanduser(self.wheelhouse),
+                                    env.host_string, self.remote_wheelhouse))
+            find_links = self.remote_wheelhouse
+
+        hook = os.path.join(env.git_repo_name, 'hooks', INSTALL_REQUIREMENTS)
+        run('%s %s %s %s %s' % (hook, env.git_repo_name, working_dir,
+                                branch, find_links))
+
+    def _update_service(self):
+        setup = functions.get_task_instance('gunicorn.setup')
+        if setup:
+            setup.update_conf()
+
+    def _reload(self):
+        execute('gunicorn.control', reload=True, hosts=[env.host_string])
+        self._warm_up()
+
+    def _warm_up(self):
+        """
+        Requests warmup_urls from env.host_string over its internal
+        ip in rounds until the slowest request of a round is faster
+        than warmup_threshold seconds, or warmup_rounds are done.
+        A round with an answer that isn't a 2xx or 3xx doesn't
+        count as warm.
+        """
+        if not self.warmup_urls:
+            return
+
+        ip = facts.get_fact('ip', default='127.0.0.1')
+        urls = [self.warmup_url % {'ip': ip, 'path': path}
+                for path in self.warmup_urls] * self.warmup_concurrency
+        header = ''
+        if self.warmup_host:
+            header = "-H 'Host: %s' " % self.warmup_host
+
+        start = time.time()
+        rounds = 0
+        warm = False
+        slowest = None
+        errors = []
+        while rounds < self.warmup_rounds and not warm:
+            rounds += 1
+            with settings(hide('running', 'output', 'warnings'),
+                          warn_only=True):
+                output = run("printf '%%s\\n' %s | xargs -n 1 -P %s "
+                             "curl -s -o /dev/null %s"
+                             "-w '%%{http_code} %%{time_total}\\n'"
+                             % (' '.join(["'%s'" % u for u in urls]),
+                                self.warmup_concurrency, header))
+            times = []
+            errors = []
+            for line in output.splitlines():
+                parts = line.split()
+                if len(parts) != 2:
+                    continue
+                if not parts[0][:1] in ('2', '3'):
+                    errors.append(parts[0])
+                try:
+                    times.append(float(parts[1]))
+                except ValueError:
+                    pass
+            slowest = times and max(times) or None
+            warm = (not errors and len(times) == len(urls) and
+                    slowest < self.warmup_threshold)
+
+        seconds = time.time() - start
+        if warm:
+            print "%s warmed up in %.1f seconds, %s rounds" % (
+                    env.host_string, seconds, rounds)
+        elif errors:
+            print "%s answered %s while warming up" % (env.host_string,
+                                            ', '.join(sorted(set(errors))))
+        else:
+            print "%s didn't warm up below %ss in %s rounds" % (
+                    env.host_string, self.warmup_threshold, rounds)
+        timings = env.get('deploy_timings', [])
+        timings.append(('warm up %s' % env.host_string, seconds))
+        env.deploy_timings = timings
+
+    def get_revision(self, branch='master'):
+        """
+        Returns the commit of branch and the hash of the
+        static files it was prepped with.
+        """
+        hashes = env.get('static_hashes', {})
+        if not branch in hashes:
+            prep = functions.get_task_instance('local.deploy.prep')
+            hashes[branch] = get_static_hash(os.path.join(
+                                prep.get_build_dir(branch), 'collected-static'))
+            env.static_hashes = hashes
+        return ('%s %s' % (functions.get_commit(branch),
+                           hashes[branch])).strip()
+
+    def _get_deployed(self):
+        """
+        Returns the revision env.host_string was last deployed
+        with, '' if it is unknown.
+        """
+        path = os.path.join(env.git_working_dir, self.deployed_file)
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = run('cat %s' % path)
+        if output.failed:
+            return ''
+        return output.strip()
+
+    def _set_deployed(self, branch):
+        path = os.path.join(env.git_working_dir, self.deployed_file)
+        run('echo "%s" > %s' % (self.get_revision(branch), path))
+
+    def run(self, branch=None, reload=False):
         """
         """
         if not branch:
             branch = 'master'
 
-        self._sync_files(branch)
-        self._post_sync()
+        if self.use_releases:
+            self._deploy_release(branch)
+            self._post_sync()
+        else:
+            self._sync_files(branch)
+            self._post_sync()
+            if self.install_requirements:
+                self._install_requirements(branch)
+        self._update_service()
+        if reload:
+            self._reload()
+        self._set_deployed(branch)
 
 class PrepDeploy(Task):
     """
     Preps your static files for deployment.
 
-    Takes one optional argument:
+    Takes the following optional arguments:
         branch: The branch that you would like to push.
                 If it is not provided 'master' will be used.
 
+        compress: Set to 'gzip' or 'brotli' to precompress
+                  the collected static files. 'brotli' writes
+                  both variants and needs the brotli module.
+                  Defaults to the compress_static attribute.
+
+
+    Internally this checks out the requested branch in a worktree
+    of its own, runs scripts/build.sh there if you have one and then
+    the django command collectstatic with your virtualenv. Your
+    working copy is left alone.
 
-    Internally this stashes any changes you have, checks out the
-    requested branch, runs rake tasks for css/js and then the
-    django command collected static.
+    The worktree of each branch is kept in worktrees_dir, by default
+    ~/.fab_deploy/worktrees/<project name>/<branch>, together with its
+    collected static and other build outputs. So later preps only
+    rebuild what changed, and different branches can be prepped at
+    the same time.
 
-    If anything was stashed in the beginning it trys to restore it.
+    When compressing, a .gz (and .br) variant is written next to
+    every compressible file using all your cores. Files whose
+    content hasn't changed since the last prep are skipped. The
+    variants are synced with the originals so nginx can serve
+    them with ``gzip_static on;`` (and ``brotli_static on;``).
+    Variants of files that are no longer compressed, also when
+    prepping without compress, are removed.
 
     This is a serial task, that should not be called directly
     with any remote hosts as it performs no remote actions.
     """
 
     serial = True
-    stash_name = 'deploy_stash'
     name = 'prep'
 
-    def _clean_working_dir(self, branch):
+    worktrees_dir = None
+
+    compress_static = None
+    # Files smaller than this are not worth compressing
+    compress_min_size = 256
+
+    def get_build_dir(self, branch='master'):
         """
+        Returns the worktree branch is prepped in.
         """
-        # Force a checkout
-        local('git stash save %s' % self.stash_name)
-        local('git checkout %s' % branch)
+        base = self.worktrees_dir
+        if not base:
+            base = os.path.join(os.path.expanduser('~'), '.fab_deploy',
+                                'worktrees', env.project_name)
+        return os.path.join(base, branch.replace('/', '-'))
 
-    def _prep_static(self):
-        build_script = os.path.join(env.project_path, 'scripts', 'build.sh')
+    def _prepare_worktree(self, branch):
+        """
+        Checks out the commit of branch in its worktree, creating
+        it the first time. Untracked build outputs are kept.
+        """
+        path = self.get_build_dir(branch)
+        commit = functions.get_commit(branch)
+        with lcd(env.project_path):
+            if not os.path.exists(os.path.join(path, '.git')):
+                local('git worktree prune')
+                local('git worktree add --detach %s %s' % (path, commit))
+            else:
+                with lcd(path):
+                    local('git checkout --force --detach %s' % commit)
+        return path
+
+    def _prep_static(self, path):
+        build_script = os.path.join(path, 'scripts', 'build.sh')
         if os.path.exists(build_script):
-            local('sh %s' % build_script)
-        local('%s/env/bin/python %s/project/manage.py collectstatic --noinput' % (env.project_path, env.project_path))
+            with lcd(path):
+                local('sh %s' % build_script)
+        local('%s/env/bin/python %s/project/manage.py collectstatic --noinput' % (env.project_path, path))
 
-    def _restore_working_dir(self):
-        with settings(warn_only=True):
-            with hide('running', 'warnings'):
-                # Fail if there was no stash by this name
-                result = local('git stash list stash@{0} | grep %s' % self.stash_name )
+    def _get_compressible(self, static_dir):
+        for root, dirs, files in os.walk(static_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if (name != COMPRESS_MANIFEST and
+                        name.endswith(COMPRESSIBLE_EXTENSIONS) and
+                        os.path.getsize(path) >= self.compress_min_size):
+                    yield path
 
-            if not result.failed:
-                local('git stash pop')
+    def _remove_stale_variants(self, static_dir, manifest, new_manifest):
+        """
+        Removes the variants written by an earlier prep for files
+        that aren't compressed now, so they aren't synced and
+        served instead of the changed original.
+        """
+        for key, (digest, with_brotli) in manifest.items():
+            exts = ['.gz', '.br']
+            if key in new_manifest:
+                exts = not new_manifest[key][1] and ['.br'] or []
+            for ext in exts:
+                variant = os.path.join(static_dir, key + ext)
+                if os.path.exists(variant):
+                    os.remove(variant)
 
-    def run(self, branch=None):
+    def _compress_static(self, compress, path):
+        """
+        Compresses the collected static of the worktree at path,
+        or only removes the variants of an earlier prep if
+        compress isn't set.
+        """
+        with_brotli = compress == 'brotli'
+        if with_brotli and not brotli:
+            print "The brotli module isn't installed, only using gzip"
+            with_brotli = False
+
+        static_dir = os.path.join(path, 'collected-static')
+        manifest_path = os.path.join(static_dir, COMPRESS_MANIFEST)
+
+        manifest = {}
+        if os.path.exists(manifest_path):
+            fp = open(manifest_path)
+            manifest = json.load(fp)
+            fp.close()
+
+        new_manifest = {}
+        todo = []
+        if compress:
+            for path in self._get_compressible(static_dir):
+                fp = open(path, 'rb')
+                digest = hashlib.sha1(fp.read()).hexdigest()
+                fp.close()
+
+                key = os.path.relpath(path, static_dir)
+                new_manifest[key] = [digest, with_brotli]
+                if manifest.get(key) != new_manifest[key]:
+                    todo.append((path, with_brotli))
+
+        self._remove_stale_variants(static_dir, manifest, new_manifest)
+
+        if todo:
+            pool = multiprocessing.Pool()
+            try:
+                pool.map(compress_file, todo)
+            finally:
+                pool.close()
+                pool.join()
+
+        if not compress:
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            return
+
+        fp = open(manifest_path, 'w')
+        json.dump(new_manifest, fp)
+        fp.close()
+        print "Compressed %s of %s static files" % (len(todo), len(new_manifest))
+
+    def run(self, branch=None, compress=None):
         """
         """
 
         if not branch:
             branch = 'master'
 
-        self._clean_working_dir(branch)
-        self._prep_static()
-        self._restore_working_dir()
+        if not compress:
+            compress = self.compress_static
+
+        path = self._prepare_worktree(branch)
+        self._prep_static(path)
+        self._compress_static(compress, path)
+
+        deploy = functions.get_task_instance('local.deploy.do')
+        if getattr(deploy, 'use_artifacts', False):
+            deploy.build_artifact(branch)
 
 do = Deploy()
 prep_deploy = PrepDeploy()
@@ -1,6 +1,17 @@
-from fabric.api import local, env, execute, run
+import os
+import sys
+import shutil
+import tempfile
+
+from fabric.api import local, env, execute, run, put
 from fabric.tasks import Task
-from fabric.context_managers import cd
+from fabric.decorators import parallel
+from fabric.context_managers import cd, settings, hide
+
+from fab_deploy import functions
+
+# The value git uses for a ref that doesn't exist yet
+NULL_SHA = '0' * 40
 
 class AddGitRemote(Task):
     """
@@ -60,6 +71,9 @@ class GitPush(Task):
 
     Will raise an error if a specified host isn't in your git
     remotes.
+
+    Hosts that ``local.git.push_many`` already brought to the
+    branch's commit are skipped.
     """
 
     name = 'push'
@@ -68,10 +82,212 @@ class GitPush(Task):
         if not branch:
            branch = 'master'
 
+        pushed = env.get('git_pushed', {}).get(env.host_string)
+        if pushed and pushed == functions.get_commit(branch):
+            print "%s is already at %s" % (env.host_string, pushed[:12])
+            return
+
         remote_name = env.git_reverse[env.host_string]
         local('git push %s %s' % (
                 remote_name, branch))
 
+class GitPushMany(Task):
+    """
+    Pushes your repo to many remotes at once.
+
+    Instead of a push per host, which makes git build a pack for
+    every one of them, the branch's commit is bundled once and the
+    bundle is uploaded to all hosts in parallel.
+
+    First the branch ref of every host is read in parallel. Hosts
+    that are already at the commit are skipped, and so are hosts
+    whose ref isn't an ancestor of the commit, as git push would
+    refuse them. The bundle only holds the commits since the merge
+    base of the refs the other hosts have, hosts without the branch
+    get a second bundle with the whole branch. On each host the
+    bundle is unpacked into the repo, the branch ref is updated and
+    the post-receive hook is called just like a push would.
+
+    Takes the following optional arguments:
+
+    * **branch**: The branch that you would like to push.
+                If it is not provided 'master' will be used.
+
+    * **targets**: A semicolon separated list of the hosts to push
+                 to. Defaults to all your git remotes.
+
+    * **force**: Also update hosts whose branch isn't an ancestor of
+               the commit, which are skipped otherwise.
+
+    This is a serial task, that should not be called with any
+    remote hosts as they are given by targets.
+    """
+
+    name = 'push_many'
+    serial = True
+    pool_size = 20
+
+    remote_bundle = '/tmp/fab-deploy-%s.bundle'
+
+    def _get_remote_ref(self, branch):
+        with cd(env.git_repo_name):
+            with settings(hide('running', 'output', 'warnings'),
+                          warn_only=True):
+                output = run('git rev-parse --verify -q refs/heads/%s'
+                             % branch)
+        if output.failed or not output.strip():
+            return NULL_SHA
+        return output.strip()
+
+    def _get_remote_refs(self, branch, hosts):
+        with settings(warn_only=True,
+                      pool_size=env.pool_size or self.pool_size):
+            results = execute(parallel(pool_size=None)(self._get_remote_ref),
+                              branch, hosts=hosts)
+
+        refs = {}
+        for host in hosts:
+            if not isinstance(results.get(host), basestring):
+                print "Couldn't read the %s ref of %s" % (branch, host)
+                sys.exit(1)
+            refs[host] = results[host]
+        return refs
+
+    def _is_known(self, commit):
+        with settings(hide('running', 'warnings'), warn_only=True):
+            result = local('git cat-file -e %s^{commit}' % commit,
+                           capture=True)
+        return result.succeeded
+
+    def _is_ancestor(self, commit, other):
+        with settings(hide('running', 'warnings'), warn_only=True):
+            result = local('git merge-base --is-ancestor %s %s'
+                           % (commit, other), capture=True)
+        return result.succeeded
+
+    def _get_base(self, commits):
+        """
+        Returns the newest commit that all commits share, None
+        if they have nothing in common.
+        """
+        if len(commits) == 1:
+            return commits[0]
+        with settings(hide('running', 'warnings'), warn_only=True):
+            result = local('git merge-base --octopus %s' % ' '.join(commits),
+                           capture=True)
+        if result.failed:
+            return None
+        return result.strip()
+
+    def _create_bundle(self, path, branch, base=None):
+        exclude = base and ' ^%s' % base or ''
+        local('git bundle create %s %s%s' % (path, branch, exclude))
+
+    def _update_host(self, bundles, branch, commit, refs):
+        """
+        Uploads the bundle for env.host_string if it has one, unpacks
+        it and runs the post-receive hook with the old and new ref.
+        """
+        remote_path = self.remote_bundle % commit[:12]
+        ref = 'refs/heads/%s' % branch
+        old = refs[env.host_string]
+
+        with cd(env.git_repo_name):
+            if bundles[env.host_string]:
+                put(bundles[env.host_string], remote_path)
+                run('git bundle unbundle %s > /dev/null; status=$?; '
+                    'rm -f %s; exit $status' % (remote_path, remote_path))
+            run('git update-ref %s %s %s' % (ref, commit, old))
+            run('if [ -x hooks/post-receive ]; then '
+                'echo "%s %s %s" | GIT_DIR=. hooks/post-receive; fi'
+                % (old, commit, ref))
+        return commit
+
+    def push(self, branch, hosts, force=False):
+        """
+        Brings all hosts to the commit of branch and returns it.
+        Hosts whose branch isn't an ancestor of the commit are
+        skipped, like git push would, unless force is set.
+        """
+        commit = functions.get_commit(branch)
+        env.git_pushed = env.get('git_pushed', {})
+
+        refs = self._get_remote_refs(branch, hosts)
+        todo = [h for h in hosts if refs[h] != commit]
+        for host in hosts:
+            if not host in todo:
+                print "%s is already at %s" % (host, commit[:12])
+                env.git_pushed[host] = commit
+        if not todo:
+            return commit
+
+        known = [h for h in todo if refs[h] != NULL_SHA and
+                 self._is_known(refs[h])]
+        forward = [h for h in known if self._is_ancestor(refs[h], commit)]
+        rejected = [h for h in todo if refs[h] != NULL_SHA and
+                    not h in forward]
+        if rejected and not force:
+            for host in rejected:
+                print ("Skipping %s, its %s isn't an ancestor of %s, "
+                       "pass force to overwrite it" % (host, branch,
+                                                       commit[:12]))
+            todo = [h for h in todo if not h in rejected]
+            if not todo:
+                return commit
+
+        # Hosts ahead of the commit already have all its objects
+        ahead = [h for h in known if h in todo and
+                 self._is_ancestor(commit, refs[h])]
+        known = [h for h in known if h in todo and not h in ahead]
+        base = None
+        if known:
+            base = self._get_base(sorted(set([refs[h] for h in known])))
+        if not base:
+            known = []
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            bundles = dict([(h, None) for h in ahead])
+            if known:
+                path = os.path.join(temp_dir, 'update.bundle')
+                self._create_bundle(path, branch, base)
+                for host in known:
+                    bundles[host] = path
+
+            full = [h for h in todo if not h in bundles]
+            if full:
+                path = os.path.join(temp_dir, 'full.bundle')
+                self._create_bundle(path, branch)
+                for host in full:
+                    bundles[host] = path
+
+            with settings(warn_only=True,
+                          pool_size=env.pool_size or self.pool_size):
+                results = execute(parallel(pool_size=None)(self._update_host),
+                                  bundles, branch, commit, refs, hosts=todo)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        failed = [h for h in todo if results.get(h) != commit]
+        for host in todo:
+            if not host in failed:
+                env.git_pushed[host] = commit
+        if failed:
+            print "Pushing to %s failed" % ', '.join(failed)
+            sys.exit(1)
+        return commit
+
+    def run(self, branch=None, targets=None, force=False):
+        if not branch:
+           branch = 'master'
+
+        if targets:
+            hosts = [h.strip() for h in targets.split(';') if h.strip()]
+        else:
+            hosts = sorted(env.git_reverse.keys())
+        if hosts:
+            self.push(branch, hosts, force=force)
+
 class GitResetRemoteHead(Task):
     """
     Deletes the remote head making the next push
@@ -84,6 +300,7 @@ class GitResetRemoteHead(Task):
             run('git update-ref -d HEAD')
 
 push = GitPush()
+push_many = GitPushMany()
 add_remote = AddGitRemote()
 rm_remote = RemoveGitRemote()
 reset_remote = GitResetRemoteHead()
@@ -0,0 +1,283 @@
+import os
+import re
+import sys
+import shutil
+import difflib
+import tempfile
+
+from fabric import api, state
+from fabric.api import env, task, settings
+from fabric.decorators import runs_once
+from fabric.network import to_dict
+from fabric.operations import _AttributeString, _AttributeList, _prefix_commands
+from fabric.task_utils import crawl, parse_kwargs
+from fabric.tasks import WrappedCallableTask
+
+from fab_deploy.base import facts
+
+class Recorder(object):
+    """
+    Records the commands tasks would run instead of running them.
+
+    While started, ``run``, ``sudo``, ``put``, ``get``, ``local`` and
+    ``execute`` are replaced in every loaded module that imported
+    them, including fabric.contrib. Executed tasks run one host after
+    the other in this process, even parallel ones, so every command
+    lands in one ordered list.
+
+    Commands return empty successful output unless one of the
+    patterns in outputs matches them, then the text given for it
+    is returned with %(host)s replaced by the current host. The
+    defaults answer the facts probe so tasks that read facts get
+    plausible values. Local commands are really run when run_local
+    is set, which is how the benchmark task times the generators.
+
+    Config changes are never written, and the local state kept by
+    facts and setup steps goes to a temporary directory that is
+    removed by stop.
+    """
+
+    PATCHED = ('run', 'sudo', 'put', 'get', 'local', 'execute')
+
+    DEFAULT_OUTPUTS = [
+        (r'^echo ip=', 'ip=%(host)s\nos=Linux\ncores=2\nmemory=2048'),
+    ]
+
+    def __init__(self, outputs=None, run_local=False):
+        self.outputs = [(re.compile(p), o) for p, o in
+                        (outputs or []) + self.DEFAULT_OUTPUTS]
+        self.run_local = run_local
+        self.steps = []
+        self._originals = {}
+        self._patched = []
+        self._saved_env = {}
+        self._temp_dir = None
+        self._conf = None
+
+    def _get_host(self):
+        return env.host_string or 'localhost'
+
+    def _get_output(self, command):
+        host = (env.host or env.host_string or 'localhost')
+        for pattern, output in self.outputs:
+            if pattern.search(command):
+                return output % {'host': host}
+        return ''
+
+    def _result(self, command, text=None):
+        if text is None:
+            text = self._get_output(command)
+        result = _AttributeString(text)
+        result.failed = False
+        result.succeeded = True
+        result.return_code = 0
+        result.command = command
+        result.real_command = command
+        result.stderr = ''
+        return result
+
+    def _record(self, kind, command, round_trips=1, size=0):
+        self.steps.append((self._get_host(), kind, command, round_trips, size))
+
+    def run(self, command, *args, **kwargs):
+        command = _prefix_commands(command, 'remote')
+        self._record('run', command)
+        return self._result(command)
+
+    def sudo(self, command, *args, **kwargs):
+        command = _prefix_commands(command, 'remote')
+        user = kwargs.get('user')
+        kind = user and 'sudo -u %s' % user or 'sudo'
+        self._record(kind, command)
+        return self._result(command)
+
+    def local(self, command, *args, **kwargs):
+        if self.run_local:
+            try:
+                with settings(warn_only=True):
+                    result = self._originals['local'](command, *args,
+                                                      **kwargs)
+            except OSError:
+                # Commands longer than the system allows can't be started
+                result = self._result(command, '')
+                result.failed = True
+                result.succeeded = False
+            kind = result.failed and 'local failed' or 'local'
+            self._record(kind, _prefix_commands(command, 'local'),
+                         round_trips=0)
+            return result
+
+        command = _prefix_commands(command, 'local')
+        self._record('local', command, round_trips=0)
+        return self._result(command)
+
+    def put(self, local_path=None, remote_path=None, *args, **kwargs):
+        size = 0
+        if hasattr(local_path, 'getvalue'):
+            size = len(local_path.getvalue())
+            name = '<file object>'
+        else:
+            name = local_path
+            if local_path and os.path.isfile(local_path):
+                size = os.path.getsize(local_path)
+        self._record('put', '%s -> %s' % (name, remote_path), size=size)
+        result = _AttributeList([remote_path])
+        result.failed = []
+        result.succeeded = True
+        return result
+
+    def get(self, remote_path, local_path=None, *args, **kwargs):
+        self._record('get', '%s -> %s' % (remote_path, local_path))
+        result = _AttributeList([])
+        result.failed = []
+        result.succeeded = True
+        return result
+
+    def execute(self, task, *args, **kwargs):
+        name = task
+        if not callable(task):
+            task = crawl(task, state.commands)
+            if task is None:
+                print "%s is not a valid task name" % name
+                sys.exit(1)
+        else:
+            name = getattr(task, 'name', getattr(task, '__name__', task))
+
+        if not hasattr(task, 'get_hosts_and_effective_roles'):
+            task = WrappedCallableTask(task)
+
+        kwargs, hosts, roles, exclude_hosts = parse_kwargs(kwargs)
+        hosts, roles = task.get_hosts_and_effective_roles(hosts, roles,
+                                                          exclude_hosts,
+                                                          env)
+
+        results = {}
+        if not hosts:
+            self._record('execute', name, round_trips=0)
+            results['<local-only>'] = task.run(*args, **kwargs)
+        for host in hosts:
+            with settings(**to_dict(host)):
+                self._record('execute', name, round_trips=0)
+                results[host] = task.run(*args, **kwargs)
+        return results
+
+    def start(self):
+        for name in self.PATCHED:
+            self._originals[name] = getattr(api, name)
+
+        for module in sys.modules.values():
+            if module is None or module is sys.modules[__name__]:
+                continue
+            for name, original in self._originals.items():
+                if getattr(module, name, None) is original:
+                    setattr(module, name, getattr(self, name))
+                    self._patched.append((module, name, original))
+
+        # Keep the local state touched by tasks out of the real files
+        self._temp_dir = tempfile.mkdtemp()
+        self._saved_env = {
+            'facts_file': env.get('facts_file'),
+            'setup_steps_dir': env.get('setup_steps_dir'),
+            'host_facts': dict(facts._load()),
+        }
+        env.facts_file = os.path.join(self._temp_dir, 'facts.json')
+        env.setup_steps_dir = os.path.join(self._temp_dir, 'steps')
+
+        self._conf = env.get('config_object')
+        if self._conf:
+            self._conf.flush()
+            self._conf.write_behind()
+            self._conf.flush = lambda: None
+
+    def stop(self):
+        for module, name, original in self._patched:
+            setattr(module, name, original)
+        self._patched = []
+
+        if self._conf:
+            self._conf.pop_changes()
+            del self._conf.flush
+
+        for key, value in self._saved_env.items():
+            if value is None:
+                env.pop(key, None)
+            else:
+                env[key] = value
+        shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+    def get_lines(self):
+        """
+        Returns the recorded steps as one line each.
+        """
+        return ['[%s] %s: %s' % (host, kind, command)
+                for host, kind, command, round_trips, size in self.steps]
+
+    def get_totals(self):
+        """
+        Returns a dict of hosts to their number of
+        round trips and uploaded bytes.
+        """
+        totals = {}
+        for host, kind, command, round_trips, size in self.steps:
+            trips, sizes = totals.get(host, (0, 0))
+            totals[host] = (trips + round_trips, sizes + size)
+        return totals
+
+@task(hosts=[])
+@runs_once
+def plan(task_name, baseline=None, save=None, **kwargs):
+    """
+    Show the commands a task would run without running them.
+
+    Runs task_name once for all the hosts given with -H or -R with
+    a ``fab_deploy.plan.Recorder`` in place of fabric's operations.
+    Prints every command in order, then the remote round trips and
+    uploaded bytes of each host.
+
+    Any other arguments are passed to the task, for example
+    ``fab plan:deploy,branch=develop``.
+
+    Takes the following optional arguments:
+
+    * **baseline**: A plan saved before. Prints a diff of the new
+                  plan against it.
+
+    * **save**: The file to save this plan to, for use as a baseline.
+    """
+
+    hosts = list(env.all_hosts)
+
+    recorder = Recorder()
+    recorder.start()
+    try:
+        recorder.execute(task_name, hosts=hosts, **kwargs)
+    finally:
+        recorder.stop()
+
+    lines = recorder.get_lines()
+    for line in lines:
+        print line
+
+    print
+    totals = recorder.get_totals()
+    for host in sorted(totals):
+        print "%s: %s round trips, %s bytes uploaded" % (host,
+                                                         totals[host][0],
+                                                         totals[host][1])
+
+    if baseline:
+        fp = open(baseline)
+        old_lines = [l.rstrip('\n') for l in fp.readlines()]
+        fp.close()
+        diff = list(difflib.unified_diff(old_lines, lines, baseline, 'plan',
+                                         lineterm=''))
+        print
+        if diff:
+            print '\n'.join(diff)
+        else:
+            print "The plan matches %s" % baseline
+
+    if save:
+        fp = open(save, 'w')
+        fp.write(''.join(['%s\n' % l for l in lines]))
+        fp.close()
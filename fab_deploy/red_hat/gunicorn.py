@@ -9,6 +9,12 @@ from fabric.context_managers import settings, hide
 
 class GunicornControl(base_gunicorn.Control):
 
+    def _get_master_pid(self):
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = sudo("status %s | grep -o 'process [0-9]*' | "
+                          "cut -d ' ' -f 2" % self.get_name())
+        return output.strip()
+
     def start(self):
         with settings(warn_only=True):
             result = sudo('start %s' % self.get_name())
@@ -39,6 +45,12 @@ class GunicornInstall(base_gunicorn.GunicornInstall):
         sudo('cp %s /etc/init/' % conf)
         sudo('initctl reload-configuration')
 
+    def _setup_tuning(self, args):
+        conf = '/etc/init/%s.conf' % self.gunicorn_name
+        sudo("sed -i '/^env GUNICORN_CMD_ARGS=/d' %s" % conf)
+        append(conf, 'env GUNICORN_CMD_ARGS="%s"' % args, use_sudo=True)
+        sudo('initctl reload-configuration')
+
     def _setup_rotate(self, path):
         text = [
         "%s {" % path,
@@ -63,3 +63,11 @@ class SlaveSetup(RHMixin, base_postgres.SlaveSetup):
     """
 
     name = 'slave_setup'
+
+
+class MultiSlaveSetup(RHMixin, base_postgres.MultiSlaveSetup):
+    """
+    Set up several slaves with streaming replication at once
+    """
+
+    name = 'multi_slave_setup'
@@ -12,9 +12,21 @@ class RHMixin(object):
     setup_snmp = False
 
     def _ssh_restart(self):
-        sudo('apt-get update')
         sudo('service sshd restart')
 
+    def _setup_package_proxy(self, proxy):
+        append('/etc/yum.conf', 'proxy=%s' % proxy, use_sudo=True)
+
+    def _installed_packages_command(self, packages):
+        return ("rpm -q --qf '%%{NAME}\\n' %s 2>/dev/null | "
+                "grep -v 'is not installed'" % ' '.join(packages))
+
+    def _update_index_command(self):
+        return 'yum -q makecache'
+
+    def _install_packages_command(self, packages):
+        return 'yum -y install %s' % ' '.join(packages)
+
 class AppMixin(RHMixin):
     rpm_urls = [
         'http://download.fedoraproject.org/pub/epel/6/i386/epel-release-6-8.noarch.rpm',
@@ -32,13 +44,11 @@ class AppMixin(RHMixin):
     ]
 
     def _install_packages(self):
-        for url in self.rpm_urls:
-            sudo('rpm -Uvh --replacepkgs %s' % url)
+        sudo('rpm -Uvh --replacepkgs %s' % ' '.join(self.rpm_urls))
         sudo('ln -sf /usr/bin/pip-python /usr/bin/pip')
         append('/etc/ld.so.conf.d/postgresql91.conf', '/usr/pgsql-9.1/lib', use_sudo=True)
         sudo('ldconfig')
-        for package in self.packages:
-            sudo('yum -y install  %s' % package)
+        self._install_package_list(self.packages)
         self._install_venv()
 
 class AppSetup(AppMixin, base_setup.AppSetup):
@@ -3,11 +3,20 @@ import os
 from fab_deploy.base import gunicorn as base_gunicorn
 
 from fabric.api import run, sudo, env
-from fabric.contrib.files import append
+from fabric.contrib.files import append, exists
 from fabric.tasks import Task
+from fabric.context_managers import settings, hide
 
 class GunicornControl(base_gunicorn.Control):
 
+    def _get_master_pid(self):
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = sudo('supervisorctl pid %s' % self.get_name())
+        output = output.strip()
+        if output.isdigit() and output != '0':
+            return output
+        return None
+
     def start(self):
         sudo('supervisorctl start %s' % self.get_name())
 
@@ -25,21 +34,76 @@ class GunicornInstall(base_gunicorn.GunicornInstall):
     user = 'www-data'
     group = 'www-data'
 
+    conf_file = '/etc/supervisor/supervisord.conf'
+
+    def _get_rendered_conf(self):
+        return '/etc/supervisor/%s.conf' % self.gunicorn_name
+
+    def _get_args_file(self):
+        return '/etc/supervisor/%s.args' % self.gunicorn_name
+
+    def _get_project_conf(self):
+        return os.path.join(env.git_working_dir, 'deploy', 'gunicorn',
+                            'supervisor_%s.conf' % self.gunicorn_name)
+
+    def _render_conf(self):
+        """
+        Renders the project's supervisor conf with the tuning merged
+        into the environment of the gunicorn program, adding an
+        environment line if it doesn't have one.
+        """
+        with settings(hide('running', 'output', 'warnings'), warn_only=True):
+            output = sudo('cat %s' % self._get_args_file())
+        args = not output.failed and output.strip() or ''
+
+        gunicorn_conf = self._get_project_conf()
+        rendered = self._get_rendered_conf()
+        if not args:
+            sudo('cp %s %s' % (gunicorn_conf, rendered))
+            return
+
+        value = 'GUNICORN_CMD_ARGS="%s"' % args
+        sudo("awk -v value='%s' -v name='%s' '"
+             "function add() { if (program && !done) print \"environment=\" value } "
+             "/^\\[/ { add(); program = index($0, \"[program:\" name \"]\") == 1; done = 0 } "
+             "program && /^environment[ \\t]*=/ { "
+             "gsub(/,?GUNICORN_CMD_ARGS=\"[^\"]*\"/, \"\"); "
+             "sub(/=,/, \"=\"); sub(/[ \\t]*$/, \"\"); "
+             "print ((/=$/ ? $0 : $0 \",\") value); done = 1; next } "
+             "{ print } END { add() }' %s > %s.new && mv %s.new %s"
+             % (value, self.gunicorn_name, gunicorn_conf, rendered,
+                rendered, rendered))
+
     def _setup_service(self, env_value=None):
         # we use supervisor to control gunicorn
         sudo('apt-get -y install supervisor')
 
-        conf_file = '/etc/supervisor/supervisord.conf'
+        # Render a copy so the tuning can be added to it,
+        # replacing any include of the project file.
+        rendered = self._get_rendered_conf()
+        self._render_conf()
+        sudo("sed -i 's#^files = %s$#files = %s#' %s" % (
+                        self._get_project_conf(), rendered, self.conf_file))
 
-        gunicorn_conf = os.path.join(env.git_working_dir, 'deploy',
-                                     'gunicorn',
-                                     'supervisor_%s.conf' % self.gunicorn_name )
+        text = 'files = %s' % rendered
 
-        text = 'files = %s' % gunicorn_conf
+        append(self.conf_file, text, use_sudo=True)
+        sudo('supervisorctl update')
 
-        append(conf_file, text, use_sudo=True)
+    def _setup_tuning(self, args):
+        sudo('echo "%s" > %s' % (args, self._get_args_file()))
+        self._render_conf()
         sudo('supervisorctl update')
 
+    def update_conf(self):
+        """
+        Re-renders the supervisor conf from the deployed project
+        so changes to it are picked up.
+        """
+        if exists(self._get_rendered_conf(), use_sudo=True):
+            self._render_conf()
+            sudo('supervisorctl update')
+
     def _setup_rotate(self, path):
         text = [
         "%s {" % path,
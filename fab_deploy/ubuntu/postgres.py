@@ -60,6 +60,14 @@ class SlaveSetup(UbuntuMixin, base_postgres.SlaveSetup):
     name = 'slave_setup'
 
 
+class MultiSlaveSetup(UbuntuMixin, base_postgres.MultiSlaveSetup):
+    """
+    Set up several slaves with streaming replication at once
+    """
+
+    name = 'multi_slave_setup'
+
+
 class PGBouncerInstall(Task):
     """
     Set up PGBouncer on a database server
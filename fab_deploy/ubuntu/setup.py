@@ -1,6 +1,7 @@
 import sys
 from fabric.api import run, sudo, execute, env
 from fabric.tasks import Task
+from fabric.contrib.files import append
 
 from fab_deploy import functions
 from fab_deploy.base import setup as base_setup
@@ -11,16 +12,30 @@ class UbuntuMixin(object):
     setup_snmp = False
 
     def _ssh_restart(self):
-        sudo('apt-get update')
         sudo('service ssh restart')
 
+    def _setup_package_proxy(self, proxy):
+        append('/etc/apt/apt.conf.d/01proxy',
+               'Acquire::http::Proxy "%s";' % proxy, use_sudo=True)
+
+    def _installed_packages_command(self, packages):
+        return ("dpkg-query -W -f='${Package} ${Status}\\n' %s 2>/dev/null | "
+                "grep 'install ok installed' | cut -d ' ' -f 1"
+                % ' '.join(packages))
+
+    def _update_index_command(self):
+        return 'apt-get update'
+
+    def _install_packages_command(self, packages):
+        return ('DEBIAN_FRONTEND=noninteractive apt-get -y install %s'
+                % ' '.join(packages))
+
 class AppMixin(UbuntuMixin):
     packages = ['python-psycopg2', 'python-setuptools', 'python-imaging',
                 'python-pip']
 
     def _install_packages(self):
-        for package in self.packages:
-            sudo('apt-get -y install  %s' % package)
+        self._install_package_list(self.packages)
         self._install_venv()
 
 class AppSetup(AppMixin, base_setup.AppSetup):